@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# MidoLuzBot - Migración y backfill de las tablas tipadas
+#
+# Crea las tablas posiciones, metricas_dispositivo y nodos (--migrar) y las
+# llena a partir del histórico de eventos, leyendo por bloques de id para no
+# cargar la tabla entera en memoria. Se puede cortar y retomar con --desde-id,
+# y correr con el bot andando: los INSERT son idempotentes.
+#
+# Con --rollups también calcula los rollups de ese rango. Esos sí se suman:
+# no correrlo dos veces sobre los mismos ids ni sobre el período en que el bot
+# ya venía calculando rollups (usar --hasta-id).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import time
+
+import mysql.connector
+
+from midoluzbotv4 import (
+    DB_CONFIG, AgregadorRollups, crear_tablas_tipadas, filas_tipadas, insertar_filas_tipadas
+)
+
+TIPOS_TIPADOS = ("POSITION_APP", "TELEMETRY_APP", "NODEINFO_APP")
+
+QUERY_BLOQUE = """
+    SELECT id, fecha_hora, tipo_paquete, emisor_id, data_json
+    FROM eventos
+    WHERE id > %s AND tipo_paquete IN (%s, %s, %s)
+    ORDER BY id
+    LIMIT %s
+"""
+
+
+def backfill(conn, desde_id, lote, hasta_id=None, rollups=False):
+    agregador = AgregadorRollups() if rollups else None
+    ultimo_id = desde_id
+    totales = {}
+    leidos = 0
+    t0 = time.monotonic()
+
+    while True:
+        cursor = conn.cursor()
+        cursor.execute(QUERY_BLOQUE, (ultimo_id, *TIPOS_TIPADOS, lote))
+        rows = cursor.fetchall()
+        if hasta_id is not None:
+            rows = [r for r in rows if r[0] <= hasta_id]
+        if not rows:
+            cursor.close()
+            break
+
+        filas = []
+        for id_evento, fecha, tipo, emisor_id, data_json in rows:
+            try:
+                payload = json.loads(data_json) if data_json else {}
+            except ValueError:
+                continue
+            if isinstance(payload, dict):
+                filas.extend(filas_tipadas(tipo, emisor_id, fecha, payload))
+
+        if agregador:
+            for tabla, fila in filas:
+                agregador.agregar(tabla, fila)
+            filas.extend(agregador.filas())
+
+        for tabla, n in insertar_filas_tipadas(cursor, filas).items():
+            totales[tabla] = totales.get(tabla, 0) + n
+        conn.commit()
+        cursor.close()
+
+        leidos += len(rows)
+        ultimo_id = rows[-1][0]
+        ritmo = leidos / max(time.monotonic() - t0, 1e-6)
+        print(f"hasta id {ultimo_id} | {leidos} eventos leídos ({ritmo:.0f}/s) | {totales}")
+
+        if len(rows) < lote:
+            break
+
+    return ultimo_id, totales
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Llena posiciones, metricas_dispositivo y nodos desde eventos")
+    parser.add_argument("--migrar", action="store_true", help="crear las tablas tipadas si no existen")
+    parser.add_argument("--desde-id", type=int, default=0, help="retomar a partir de este id de eventos")
+    parser.add_argument("--hasta-id", type=int, default=None, help="no procesar eventos con id mayor a este")
+    parser.add_argument("--rollups", action="store_true",
+                        help="calcular también los rollups (se suman: no repetir sobre el mismo rango)")
+    parser.add_argument("--lote", type=int, default=5000, help="eventos leídos por consulta")
+    parser.add_argument("--user", help="usuario MySQL (por defecto el de DB_CONFIG)")
+    parser.add_argument("--password", help="contraseña MySQL (por defecto la de DB_CONFIG)")
+    args = parser.parse_args()
+
+    config = dict(DB_CONFIG)
+    if args.user:
+        config["user"] = args.user
+    if args.password:
+        config["password"] = args.password
+
+    conn = mysql.connector.connect(**config)
+    try:
+        if args.migrar:
+            cursor = conn.cursor()
+            crear_tablas_tipadas(cursor)
+            cursor.close()
+            print("Tablas tipadas creadas/verificadas")
+
+        ultimo_id, totales = backfill(conn, args.desde_id, args.lote, args.hasta_id, args.rollups)
+        print(f"Listo. Último id procesado: {ultimo_id} | filas enviadas por tabla: {totales}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# MidoLuzBot - Benchmark de on_receive
+#
+# Mide cuántos paquetes por segundo aguanta MeshtasticCommandBot.on_receive sin
+# radio ni MySQL: los paquetes (sintéticos o grabados, uno por línea en JSONL)
+# entran directo al handler, la interfaz es de mentira y las inserciones van a
+# un SQLite en memoria o solo se cuentan. Informa throughput, p50/p99 de cada
+# etapa de on_receive (las mismas de /metrics) y cuánto creció la memoria.
+#
+#   python3 bench_on_receive.py --paquetes 50000 --salida base.json
+#   ... cambio en el pipeline ...
+#   python3 bench_on_receive.py --paquetes 50000 --comparar base.json
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import midoluzbotv4
+from midoluzbotv4 import MeshtasticCommandBot
+
+MEZCLA_DEFAULT = "TEXT=15,POSITION=30,NODEINFO=10,TELEMETRY=35,ROUTING=10"
+ETAPAS = ("dedup", "etiquetas", "decodificacion", "log", "encolado_db")
+
+
+# ------------------------
+# STAND-INS
+# ------------------------
+
+class InterfazFalsa:
+    """Lo mínimo que el bot usa de TCPInterface; guarda lo que se transmite."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.failure = None
+        self.enviados = []
+        self._ids = itertools.count(1)
+
+    def _paquete(self, tipo, kwargs):
+        paquete = type("Paquete", (), {"id": next(self._ids)})()
+        self.enviados.append((tipo, kwargs))
+        return paquete
+
+    def sendText(self, **kwargs):
+        return self._paquete("texto", kwargs)
+
+    def sendData(self, **kwargs):
+        return self._paquete("datos", kwargs)
+
+    def close(self):
+        pass
+
+
+class CursorSQLite:
+    """Traduce los INSERT de MySQL a una tabla SQLite sin restricciones con las mismas columnas."""
+
+    _INSERT = re.compile(r"INSERT\s+(?:IGNORE\s+)?INTO\s+(\w+)\s*\(([^)]*)\)", re.IGNORECASE)
+
+    def __init__(self, conn, tablas):
+        self.conn = conn
+        self.tablas = tablas
+
+    def executemany(self, query, valores):
+        tabla, columnas = self._INSERT.search(query).groups()
+        columnas = [c.strip() for c in columnas.split(",")]
+        if tabla not in self.tablas:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ({', '.join(columnas)})")
+            self.tablas.add(tabla)
+        marcas = ", ".join("?" * len(columnas))
+        filas = [tuple(str(v) if isinstance(v, datetime) else v for v in fila) for fila in valores]
+        self.conn.executemany(f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({marcas})", filas)
+
+    def close(self):
+        pass
+
+
+class PoolFalso:
+    """Reemplaza a pool_db: SQLite en memoria (--db sqlite) o solo contar filas (--db memoria)."""
+
+    def __init__(self, motor):
+        self.motor = motor
+        self.reconexiones = 0
+        self.filas = defaultdict(int)
+        self._lock = threading.Lock()
+        self._tablas = set()
+        self._sqlite = sqlite3.connect(":memory:", check_same_thread=False) if motor == "sqlite" else None
+
+    @contextmanager
+    def conexion(self):
+        with self._lock:
+            yield self
+
+    def cursor(self):
+        if self._sqlite is not None:
+            return _CursorContador(self, CursorSQLite(self._sqlite, self._tablas))
+        return _CursorContador(self, None)
+
+    def commit(self):
+        if self._sqlite is not None:
+            self._sqlite.commit()
+
+
+class _CursorContador:
+    def __init__(self, pool, cursor):
+        self.pool = pool
+        self.cursor = cursor
+
+    def executemany(self, query, valores):
+        valores = list(valores)
+        tabla = CursorSQLite._INSERT.search(query).group(1)
+        self.pool.filas[tabla] += len(valores)
+        if self.cursor is not None:
+            self.cursor.executemany(query, valores)
+
+    def close(self):
+        pass
+
+
+class BotBench(MeshtasticCommandBot):
+    """El bot real, guardando además cada duración de etapa para sacar percentiles exactos."""
+
+    duraciones = defaultdict(list)
+
+    @staticmethod
+    def _etapa(nombre, t0):
+        ahora = MeshtasticCommandBot._etapa(nombre, t0)
+        BotBench.duraciones[nombre].append(ahora - t0)
+        return ahora
+
+
+# ------------------------
+# PAQUETES
+# ------------------------
+
+def paquetes_sinteticos(cantidad, mezcla, nodos, duplicados, semilla):
+    azar = random.Random(semilla)
+    tipos, pesos = zip(*mezcla.items())
+    ids = [0x10000000 + i for i in range(nodos)]
+    emitidos = []
+    for n in range(cantidad):
+        if emitidos and azar.random() < duplicados:
+            # Otra copia de un paquete reciente, que llegó por otro camino
+            copia = dict(azar.choice(emitidos[-200:]))
+            copia["hopLimit"] = max(0, copia["hopLimit"] - 1)
+            yield copia
+            continue
+
+        origen = azar.choice(ids)
+        paquete = {
+            "from": origen, "fromId": f"!{origen:08x}",
+            "to": 0xffffffff, "toId": "^all",
+            "id": azar.getrandbits(32) or 1,
+            "hopStart": 3, "hopLimit": azar.randint(0, 3),
+            "rxSnr": round(azar.uniform(-15, 10), 2), "rxRssi": azar.randint(-120, -40),
+        }
+        tipo = azar.choices(tipos, pesos)[0]
+        if tipo == "TEXT":
+            texto = "/ping" if azar.random() < 0.05 else f"mensaje de prueba {n} " + "x" * azar.randint(0, 120)
+            paquete["decoded"] = {"portnum": "TEXT_MESSAGE_APP", "text": texto}
+        elif tipo == "POSITION":
+            paquete["decoded"] = {"portnum": "POSITION_APP", "position": {
+                "latitude": -34.6 + azar.uniform(-0.3, 0.3), "longitude": -58.4 + azar.uniform(-0.3, 0.3),
+                "altitude": azar.randint(0, 120), "sats": azar.randint(3, 14), "PDOP": azar.randint(80, 400),
+            }}
+        elif tipo == "NODEINFO":
+            paquete["decoded"] = {"portnum": "NODEINFO_APP", "user": {
+                "id": f"!{origen:08x}", "longName": f"Nodo {origen & 0xffff:04x}",
+                "shortName": f"{origen & 0xffff:04x}", "hwModel": "TBEAM",
+            }}
+        elif tipo == "TELEMETRY":
+            paquete["decoded"] = {"portnum": "TELEMETRY_APP", "telemetry": {"deviceMetrics": {
+                "batteryLevel": azar.randint(5, 101), "voltage": round(azar.uniform(3.3, 4.2), 3),
+                "channelUtilization": round(azar.uniform(0, 40), 2), "airUtilTx": round(azar.uniform(0, 5), 2),
+                "uptimeSeconds": azar.randint(0, 10 ** 6),
+            }}}
+        else:
+            paquete["decoded"] = {"portnum": "ROUTING_APP", "requestId": azar.getrandbits(32),
+                                  "routing": {"errorReason": "NONE"}}
+        emitidos.append(paquete)
+        yield paquete
+
+
+def paquetes_grabados(ruta, cantidad):
+    with open(ruta, encoding="utf-8") as f:
+        lineas = [json.loads(l) for l in f if l.strip()]
+    for n in range(cantidad):
+        yield lineas[n % len(lineas)]
+
+
+# ------------------------
+# MEDICIÓN
+# ------------------------
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # Sin /proc (macOS): el máximo es lo mejor que hay
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+
+def preparar(args):
+    midoluzbotv4.pool_db = PoolFalso(args.db)
+    bot = BotBench()
+    bot.interface = InterfazFalsa()
+    midoluzbotv4.mesh_bot_instance = bot
+
+    if args.log != "consola":
+        # Se sigue formateando cada línea en el hilo de logging (es parte del costo),
+        # pero no se escribe en la terminal
+        modo = "json" if args.log == "json" else "consola"
+        midoluzbotv4.configurar_logging(modo=modo, salida=open(os.devnull, "w"))
+        if args.log == "off":
+            logging.getLogger("MeshBot").setLevel(logging.WARNING)
+
+    midoluzbotv4.escritor_db.start()
+    midoluzbotv4.ejecutor_comandos.start()
+    midoluzbotv4.planificador_tx.start()
+    return bot
+
+
+def correr(args):
+    mezcla = {}
+    for parte in args.mezcla.split(","):
+        tipo, peso = parte.split("=")
+        mezcla[tipo.strip().upper()] = float(peso)
+
+    total = args.calentamiento + args.paquetes
+    if args.grabados:
+        fuente = paquetes_grabados(args.grabados, total)
+    else:
+        fuente = paquetes_sinteticos(total, mezcla, args.nodos, args.duplicados, args.semilla)
+    # Los paquetes se arman antes de medir: no cuenta el costo de generarlos
+    paquetes = list(fuente)
+    calentamiento, paquetes = paquetes[:args.calentamiento], paquetes[args.calentamiento:]
+
+    bot = preparar(args)
+    for paquete in calentamiento:
+        bot.on_receive(paquete, bot.interface)
+    BotBench.duraciones.clear()
+
+    gc.collect()
+    rss_inicio = rss_mb()
+    objetos_inicio = len(gc.get_objects())
+    latencias = []
+    rss_tramos = []
+    tramo = max(1, len(paquetes) // 10)
+    pausa = 1.0 / args.tasa if args.tasa else 0.0
+
+    t0 = time.perf_counter()
+    for n, paquete in enumerate(paquetes, 1):
+        inicio = time.perf_counter()
+        bot.on_receive(paquete, bot.interface)
+        latencias.append(time.perf_counter() - inicio)
+        if pausa:
+            espera = t0 + n * pausa - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+        if n % tramo == 0:
+            rss_tramos.append(round(rss_mb(), 1))
+    t_handler = time.perf_counter() - t0
+
+    # Hasta que el escritor insertó todo: stop() lo despierta sin esperar
+    # DB_BATCH_INTERVALO (eso es latencia, no throughput) y vuelve después del último flush
+    midoluzbotv4.escritor_db.stop(timeout=120)
+    t_total = time.perf_counter() - t0
+    midoluzbotv4.ejecutor_comandos.stop()
+    midoluzbotv4.planificador_tx.stop()
+
+    gc.collect()
+    latencias.sort()
+    etapas = {}
+    for etapa in ETAPAS:
+        valores = sorted(BotBench.duraciones.get(etapa, ()))
+        etapas[etapa] = {
+            "n": len(valores),
+            "p50_us": round(1e6 * percentil(valores, 50), 2),
+            "p99_us": round(1e6 * percentil(valores, 99), 2),
+        }
+
+    return {
+        "paquetes": len(paquetes),
+        "mezcla": args.grabados or args.mezcla,
+        "db": args.db,
+        "log": args.log,
+        "paquetes_por_s": round(len(paquetes) / t_handler, 1),
+        "paquetes_por_s_con_db": round(len(paquetes) / t_total, 1),
+        "on_receive_p50_us": round(1e6 * percentil(latencias, 50), 2),
+        "on_receive_p99_us": round(1e6 * percentil(latencias, 99), 2),
+        "etapas": etapas,
+        "filas_insertadas": dict(midoluzbotv4.pool_db.filas),
+        "eventos_descartados": midoluzbotv4.escritor_db.descartados,
+        "duplicados": midoluzbotv4.indice_duplicados.duplicados,
+        "enviados_radio": len(bot.interface.enviados),
+        "rss_inicio_mb": round(rss_inicio, 1),
+        "rss_fin_mb": round(rss_mb(), 1),
+        "rss_por_tramo_mb": rss_tramos,
+        "objetos_gc_nuevos": len(gc.get_objects()) - objetos_inicio,
+    }
+
+
+def imprimir(r, base=None):
+    def delta(clave, valor, mejor_mayor):
+        if not base or clave not in base or not base[clave]:
+            return ""
+        cambio = 100 * (valor - base[clave]) / base[clave]
+        signo = "+" if cambio >= 0 else ""
+        bien = (cambio >= 0) == mejor_mayor
+        return f"  ({signo}{cambio:.1f}% {'mejor' if bien else 'peor'})"
+
+    print(f"\n{r['paquetes']} paquetes | mezcla {r['mezcla']} | db {r['db']} | log {r['log']}")
+    print(f"Throughput on_receive : {r['paquetes_por_s']:>10.1f} paq/s{delta('paquetes_por_s', r['paquetes_por_s'], True)}")
+    print(f"Throughput con DB     : {r['paquetes_por_s_con_db']:>10.1f} paq/s"
+          f"{delta('paquetes_por_s_con_db', r['paquetes_por_s_con_db'], True)}")
+    print(f"on_receive p50 / p99  : {r['on_receive_p50_us']:>8.1f} / {r['on_receive_p99_us']:.1f} µs"
+          f"{delta('on_receive_p99_us', r['on_receive_p99_us'], False)}")
+    print(f"\n{'Etapa':<16}{'n':>8}{'p50 µs':>10}{'p99 µs':>10}")
+    for etapa, e in r["etapas"].items():
+        previo = (base or {}).get("etapas", {}).get(etapa)
+        extra = f"   base p50 {previo['p50_us']} / p99 {previo['p99_us']}" if previo else ""
+        print(f"{etapa:<16}{e['n']:>8}{e['p50_us']:>10.2f}{e['p99_us']:>10.2f}{extra}")
+    print(f"\nFilas insertadas: {r['filas_insertadas']} | descartadas: {r['eventos_descartados']} "
+          f"| duplicados: {r['duplicados']} | enviados a la radio: {r['enviados_radio']}")
+    print(f"RSS: {r['rss_inicio_mb']} -> {r['rss_fin_mb']} MB{delta('rss_fin_mb', r['rss_fin_mb'], False)} "
+          f"| por tramo: {r['rss_por_tramo_mb']} | objetos nuevos: {r['objetos_gc_nuevos']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de MeshtasticCommandBot.on_receive sin radio ni MySQL")
+    parser.add_argument("--paquetes", type=int, default=20000, help="paquetes a procesar")
+    parser.add_argument("--mezcla", default=MEZCLA_DEFAULT,
+                        help="pesos por tipo: TEXT, POSITION, NODEINFO, TELEMETRY, ROUTING")
+    parser.add_argument("--grabados", help="JSONL con paquetes grabados (uno por línea) en vez de sintéticos")
+    parser.add_argument("--nodos", type=int, default=60, help="nodos distintos en los paquetes sintéticos")
+    parser.add_argument("--duplicados", type=float, default=0.15, help="fracción de copias repetidas")
+    parser.add_argument("--tasa", type=float, default=0, help="paquetes por segundo (0 = lo más rápido posible)")
+    parser.add_argument("--db", choices=("sqlite", "memoria"), default="sqlite",
+                        help="dónde van los inserts: SQLite en memoria o solo contar filas")
+    parser.add_argument("--log", choices=("devnull", "json", "consola", "off"), default="devnull",
+                        help="devnull y json formatean las líneas (con colores o en JSON) pero no las muestran")
+    parser.add_argument("--calentamiento", type=int, default=500, help="paquetes procesados antes de medir")
+    parser.add_argument("--semilla", type=int, default=1, help="semilla de los paquetes sintéticos")
+    parser.add_argument("--salida", help="guardar el resultado en JSON (para usar de base)")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior contra el que comparar")
+    args = parser.parse_args()
+
+    resultado = correr(args)
+    base = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            base = json.load(f)
+    imprimir(resultado, base)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# MidoLuzBot - Micro-benchmark de la serialización de payloads a JSON
+#
+# Compara el serializar_para_json original (isinstance recursivo + json.dumps)
+# contra payload_a_json de midoluzbotv4.py, con payloads como los que arma
+# on_receive para POSITION, TELEMETRY y NODEINFO. En NODEINFO va la clave "raw"
+# con el protobuf que meshtastic agrega a decoded["user"]; en TELEMETRY no, porque
+# meshtastic la pone en decoded["telemetry"] y el bot guarda solo deviceMetrics.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import timeit
+
+from meshtastic.protobuf import mesh_pb2
+
+import midoluzbotv4
+
+REPETICIONES = 20000
+
+
+def serializar_para_json_original(obj):
+    if isinstance(obj, (int, float, str, bool, type(None))):
+        return obj
+    if isinstance(obj, dict):
+        return {str(k): serializar_para_json_original(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [serializar_para_json_original(i) for i in obj]
+    if hasattr(obj, "__dict__"):
+        return str(obj)
+    return str(obj)
+
+
+def payloads():
+    usuario = mesh_pb2.User(
+        id="!abcd1234", long_name="Nodo Palermo 🏙️", short_name="PLRM",
+        macaddr=b"\x12\x34\xab\xcd\x12\x34", hw_model=9, public_key=bytes(range(32))
+    )
+
+    return {
+        "POSITION": {
+            "latitude": -34.6037, "longitude": -58.3816, "altitude": 25, "sats": 9, "PDOP": 120,
+            "_mesh": {"hops": 1, "hops_min": 1, "duplicados": 0},
+        },
+        "TELEMETRY": {
+            "batteryLevel": 87, "voltage": 4.02, "channelUtilization": 12.5,
+            "airUtilTx": 1.3, "uptimeSeconds": 86400,
+            "_mesh": {"hops": 2, "hops_min": 2, "duplicados": 1},
+        },
+        "NODEINFO": {
+            "id": "!abcd1234", "longName": "Nodo Palermo 🏙️", "shortName": "PLRM",
+            "macaddr": b"\x12\x34\xab\xcd\x12\x34", "hwModel": "TBEAM", "raw": usuario,
+            "_mesh": {"hops": 0, "hops_min": 0, "duplicados": 3},
+        },
+    }
+
+
+def main():
+    motor = "orjson" if midoluzbotv4.orjson is not None and midoluzbotv4.JSON_RAPIDO else "json"
+    print(f"{REPETICIONES} repeticiones por caso, backend nuevo: {motor}\n")
+    print(f"{'Payload':<12}{'original µs':>14}{'nuevo µs':>12}{'mejora':>10}")
+    for nombre, payload in payloads().items():
+        original = timeit.timeit(
+            lambda: json.dumps(serializar_para_json_original(payload)), number=REPETICIONES
+        )
+        nuevo = timeit.timeit(lambda: midoluzbotv4.payload_a_json(payload), number=REPETICIONES)
+        print(
+            f"{nombre:<12}{1e6 * original / REPETICIONES:>14.2f}"
+            f"{1e6 * nuevo / REPETICIONES:>12.2f}{original / nuevo:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -20,10 +20,14 @@
 import sys
 import time
 import logging
+from contextlib import contextmanager
 from datetime import datetime
 from pubsub import pub
 import mysql.connector
+import mysql.connector.pooling
 import json
+import queue
+import threading
 
 try:
     import meshtastic
@@ -61,26 +65,167 @@ def serializar_para_json(obj):
         return str(obj)
     return str(obj)
 
+# ------------------------
+# POOL DE CONEXIONES DB
+# ------------------------
+
+DB_POOL_SIZE = 4           # conexiones abiertas compartidas por todo el bot
+DB_POOL_ESPERA = 5.0       # segundos máximos esperando una conexión libre
+
+
+class PoolDB:
+    """Pool único de conexiones MySQL: valida cada conexión al sacarla y reconecta si MySQL se reinició."""
+
+    def __init__(self, config, tamanio=DB_POOL_SIZE, espera=DB_POOL_ESPERA):
+        self.config = config
+        self.tamanio = tamanio
+        self.espera = espera
+        self.reconexiones = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _obtener_pool(self):
+        # Se crea recién en el primer uso: si MySQL no está al arrancar se reintenta en la próxima llamada
+        with self._lock:
+            if self._pool is None:
+                self._pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="midoluz",
+                    pool_size=self.tamanio,
+                    pool_reset_session=True,
+                    **self.config
+                )
+            return self._pool
+
+    def _sacar(self):
+        limite = time.monotonic() + self.espera
+        while True:
+            try:
+                return self._obtener_pool().get_connection()
+            except mysql.connector.errors.PoolError:
+                # Pool agotado: esperamos a que alguien devuelva una conexión
+                if time.monotonic() >= limite:
+                    raise
+                time.sleep(0.05)
+
+    @contextmanager
+    def conexion(self):
+        conn = self._sacar()
+        try:
+            if not conn.is_connected():
+                self.reconexiones += 1
+                conn.reconnect(attempts=2, delay=1)
+            yield conn
+        finally:
+            # En una conexión del pool, close() la devuelve al pool
+            conn.close()
+
+
+pool_db = PoolDB(DB_CONFIG)
+
+
+# ------------------------
+# ESCRITOR DB EN LOTE
+# ------------------------
+
+# on_receive corre en el hilo lector de meshtastic: no puede esperar a MySQL.
+# Los eventos se encolan y un hilo aparte los inserta en lote con un solo commit.
+DB_BATCH_MAX = 100         # filas por INSERT multi-fila
+DB_BATCH_INTERVALO = 2.0   # segundos máximos que una fila espera en la cola
+DB_COLA_MAX = 10000        # tope de la cola: si se llena se descartan eventos
+
+QUERY_INSERT_EVENTO = """
+    INSERT INTO eventos (fecha_hora, tipo_paquete, emisor_id, emisor_name, receptor_id, data_json)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+
+class EscritorDB:
+    """Drena la cola de eventos y los guarda con executemany + un commit por lote."""
+
+    def __init__(self, batch_max=DB_BATCH_MAX, intervalo=DB_BATCH_INTERVALO, cola_max=DB_COLA_MAX):
+        self.batch_max = batch_max
+        self.intervalo = intervalo
+        self.cola = queue.Queue(maxsize=cola_max)
+        self.descartados = 0
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def start(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._loop, name="EscritorDB", daemon=True)
+        self._hilo.start()
+
+    def stop(self, timeout=10):
+        """Pide al hilo que vacíe la cola, haga el último flush y termine."""
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def encolar(self, fila):
+        try:
+            self.cola.put_nowait(fila)
+            return True
+        except queue.Full:
+            self.descartados += 1
+            return False
+
+    def _loop(self):
+        lote = []
+        limite = None
+        while True:
+            espera = self.intervalo if limite is None else max(0.0, limite - time.monotonic())
+            try:
+                fila = self.cola.get(timeout=espera)
+                if limite is None:
+                    limite = time.monotonic() + self.intervalo
+                lote.append(fila)
+            except queue.Empty:
+                pass
+
+            # Flush por tamaño o por tiempo, lo que ocurra primero
+            if lote and (len(lote) >= self.batch_max or time.monotonic() >= limite):
+                self._flush(lote)
+                lote = []
+                limite = None
+
+            if self._detener.is_set():
+                while True:
+                    try:
+                        lote.append(self.cola.get_nowait())
+                    except queue.Empty:
+                        break
+                    if len(lote) >= self.batch_max:
+                        self._flush(lote)
+                        lote = []
+                if lote:
+                    self._flush(lote)
+                return
+
+    def _flush(self, lote):
+        try:
+            valores = [
+                (fecha, tipo, emisor_id, emisor_name, receptor_id, json.dumps(serializar_para_json(extra)))
+                for fecha, tipo, emisor_id, emisor_name, receptor_id, extra in lote
+            ]
+            with pool_db.conexion() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(QUERY_INSERT_EVENTO, valores)
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            print(f"{Fore.RED}[DB ERROR] lote de {len(lote)} eventos: {e}{Style.RESET_ALL}")
+
+
+escritor_db = EscritorDB()
+
+
 def registrar_en_db(tipo, emisor_id, emisor_name, receptor_id, extra_data):
-    try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        # Limpiamos profundamente la data antes de convertir a JSON
-        data_limpia = serializar_para_json(extra_data)
-        
-        query = """
-            INSERT INTO eventos (tipo_paquete, emisor_id, emisor_name, receptor_id, data_json)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        valores = (tipo, emisor_id, emisor_name, receptor_id, json.dumps(data_limpia))
-        cursor.execute(query, valores)
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        # Imprimimos el error pero no dejamos que el bot muera
-        print(f"{Fore.RED}[DB ERROR] {e}{Style.RESET_ALL}")
+    # La hora se toma al recibir el paquete, no al insertar el lote
+    if not escritor_db.encolar((datetime.now(), tipo, emisor_id, emisor_name, receptor_id, extra_data)):
+        print(f"{Fore.RED}[DB ERROR] Cola llena, evento descartado ({escritor_db.descartados}){Style.RESET_ALL}")
+
 
 # ------------------------
 # Funciones de API
@@ -267,5 +412,10 @@ class MeshtasticCommandBot:
 
 if __name__ == "__main__":
     bot = MeshtasticCommandBot()
-    if bot.connect(IP_NODO):
-        bot.start()
\ No newline at end of file
+    escritor_db.start()
+    try:
+        if bot.connect(IP_NODO):
+            bot.start()
+    finally:
+        # Último flush de lo que haya quedado en la cola
+        escritor_db.stop()
@@ -19,33 +19,175 @@
 
 # 3/7 agregado endpoint para enviar clima!
 
+import os
 import sys
 import time
 import logging
-from datetime import datetime
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pubsub import pub
 import mysql.connector
+import mysql.connector.pooling
+import base64
+import bisect
 import json
-
-
+import re
+import queue
+import random
+import socket
+import sqlite3
 import threading
+import heapq
+import itertools
+import uuid
+from collections import Counter, defaultdict, deque, OrderedDict
+
 
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, constr,Field
+from typing import List, Optional
 import uvicorn
+import requests
+from requests.adapters import HTTPAdapter
 
 try:
     import meshtastic
     import meshtastic.serial_interface
     import meshtastic.tcp_interface
-    from meshtastic.protobuf import telemetry_pb2, portnums_pb2
+    from meshtastic.protobuf import mesh_pb2, telemetry_pb2, portnums_pb2
+    from google.protobuf.json_format import MessageToDict
+    from google.protobuf.message import Message as ProtoMessage
     from colorama import Fore, Style, init
     init(autoreset=True)
 except ImportError as e:
     print(f"ERROR: Falta instalar dependencias: {e}")
     sys.exit(1)
 
+# Opcional: serialización JSON más rápida
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ------------------------
+# LOGGING
+# ------------------------
+
+# Los hilos del bot solo encolan el LogRecord; el formateo (colores, padding,
+# JSON) y la escritura los hace el hilo del QueueListener. Los paquetes se
+# loguean con sus datos en record.paquete y la línea se arma recién al emitirla.
+LOG_MODO = "consola"       # "consola" (colores) o "json" (una línea JSON por registro, a stdout)
+LOG_NIVEL = logging.INFO
+LOG_COLA_MAX = 10000       # registros esperando al listener; si se llena se descartan
+
+LOG_FORMATO_CONSOLA = (
+    f"{Fore.WHITE}{Style.DIM}%(asctime)s{Style.RESET_ALL} "
+    f"{Fore.GREEN}{Style.BRIGHT}[%(levelname)s]{Style.RESET_ALL} %(message)s"
+)
+
+# portnum -> (título, estilo, detalle). El detalle se completa con los campos del paquete.
+ESTILOS_PAQUETE = {
+    "TEXT_MESSAGE_APP": ("Text Message", f"{Fore.WHITE}{Style.BRIGHT}", f"{Fore.MAGENTA}Msg: {{text}}"),
+    "POSITION_APP": ("Position", f"{Fore.BLUE}{Style.BRIGHT}", f"{Style.DIM}Lat: {{lat}}, Lon: {{lon}}, Alt: {{alt}}m"),
+    "NODEINFO_APP": ("Node Info", f"{Fore.YELLOW}{Style.BRIGHT}", f"{Style.DIM}Name: {{name}} | HW: {{hw}}"),
+    "TELEMETRY_APP": ("Telemetry", f"{Fore.MAGENTA}{Style.BRIGHT}", f"{Style.DIM}Volt: {{volt}}V, Bat: {{bat}}%"),
+    "ROUTING_APP": ("Routing", f"{Fore.CYAN}{Style.DIM}", f"{Style.DIM}Mesh Routing Packet"),
+    "RANGE_TEST_APP": ("Range Test", f"{Fore.GREEN}{Style.BRIGHT}", f"{Style.DIM}Seq: {{seq}}"),
+    "DETECTION_SENSOR_APP": ("Sensor Alert", f"{Fore.RED}{Style.BRIGHT}", f"{Fore.RED}SENSOR TRIGGERED"),
+    "ADMIN_APP": ("Admin", f"{Fore.RED}", "Admin Config Packet"),
+}
+
+_ANSI = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class FormatoConsola(logging.Formatter):
+    """El formato de siempre, con colores; arma la línea de cada paquete a partir de record.paquete."""
+
+    def __init__(self):
+        super().__init__(LOG_FORMATO_CONSOLA, datefmt="%H:%M:%S")
+
+    def formatMessage(self, record):
+        paquete = getattr(record, "paquete", None)
+        if paquete is not None:
+            titulo, estilo, detalle = ESTILOS_PAQUETE[paquete["tipo"]]
+            peers = (f"{Fore.CYAN}{Style.BRIGHT}{paquete['de']:>6}{Style.RESET_ALL} -> "
+                     f"{Fore.YELLOW}{Style.BRIGHT}{paquete['a']:<6}")
+            record.message = f"{estilo}{titulo:<18} {peers} {detalle.format(**paquete)}"
+        return super().formatMessage(record)
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por registro, sin códigos de color, para journald/Loki/jq."""
+
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "hilo": record.threadName,
+            "msg": _ANSI.sub("", record.getMessage()),
+        }
+        paquete = getattr(record, "paquete", None)
+        if paquete is not None:
+            datos["paquete"] = paquete
+        if record.exc_info:
+            datos["exc"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class HandlerCola(logging.handlers.QueueHandler):
+    """QueueHandler que no formatea en el hilo que loguea y descarta si la cola está llena."""
+
+    descartados = 0
+
+    def prepare(self, record):
+        # El QueueHandler estándar formatea acá; lo dejamos para el listener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            HandlerCola.descartados += 1
+
+
+_listener_log = None
+
+
+def configurar_logging(modo=None, nivel=None, salida=None):
+    """Configura el logging del proceso (se puede llamar de nuevo para cambiar modo o salida)."""
+    global _listener_log
+    modo = modo or LOG_MODO
+    if salida is None:
+        salida = sys.stdout if modo == "json" else sys.stderr
+
+    handler = logging.StreamHandler(salida)
+    handler.setFormatter(FormatoJSON() if modo == "json" else FormatoConsola())
+    cola = queue.Queue(maxsize=LOG_COLA_MAX)
+    raiz = logging.getLogger()
+    for previo in list(raiz.handlers):
+        raiz.removeHandler(previo)
+    raiz.addHandler(HandlerCola(cola))
+    raiz.setLevel(nivel or LOG_NIVEL)
+    # El listener anterior (si lo hay) se detiene después del cambio: así vacía su cola
+    anterior = _listener_log
+    _listener_log = logging.handlers.QueueListener(cola, handler, respect_handler_level=True)
+    _listener_log.start()
+    if anterior is not None:
+        anterior.stop()
+
+
+def detener_logging():
+    """Escribe lo que quedó en la cola y detiene el hilo del listener."""
+    global _listener_log
+    if _listener_log is not None:
+        _listener_log.stop()
+        _listener_log = None
+
+
 # ------------------------
 # DB CONFIG
 # ------------------------
@@ -86,11 +228,12 @@ class SendMessageRequest(BaseModel):
 mesh_bot_instance = None
 
 @app.post("/SendMessage",tags=["Mensajería Mesh"], summary="Enviar mensaje a la red mesh",
+    status_code=202,
     description=(
-        "Envía un mensaje de texto a un canal desde HTTP. "
-        "Máximo 200 caracteres."
+        "Encola un mensaje de texto a un canal desde HTTP y responde enseguida. "
+        "Máximo 200 caracteres. El avance se consulta en /SendStatus/{id}."
     ),
-    response_description="Confirmación simple de envío al canal indicado")
+    response_description="Id del envío encolado")
     
 async def send_message(req: SendMessageRequest):
     global mesh_bot_instance
@@ -98,20 +241,16 @@ async def send_message(req: SendMessageRequest):
     if not mesh_bot_instance or not mesh_bot_instance.interface:
         raise HTTPException(status_code=503, detail="Bot no conectado")
 
-    try:
-        mesh_bot_instance.interface.sendText(
-            text=req.message,
-            channelIndex=req.channel
-        )
+    envio = planificador_tx.texto(req.message, prioridad=PRIORIDAD_BULK, channelIndex=req.channel)
+    if envio.estado == "error":
+        raise HTTPException(status_code=503, detail=envio.error)
 
-        return {
-            "status": "Mensaje Enviado!",
-            "channel": req.channel,
-            "message": req.message
-        }
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "Mensaje en cola",
+        "id": envio.id,
+        "channel": req.channel,
+        "message": req.message
+    }
 
 
 class SendDirectMessageRequest(BaseModel):
@@ -135,7 +274,8 @@ class SendDirectMessageRequest(BaseModel):
         "Envía un mensaje privado a un nodo específico de la red mesh. "
         "No usa canal broadcast: el paquete se enruta directo al NodeID."
     ),
-    response_description="Confirmación de envío al nodo destino"
+    status_code=202,
+    response_description="Id del envío encolado; el ACK del nodo destino se ve en /SendStatus/{id}"
 )
 async def send_direct_message(req: SendDirectMessageRequest):
     global mesh_bot_instance
@@ -143,20 +283,93 @@ async def send_direct_message(req: SendDirectMessageRequest):
     if not mesh_bot_instance or not mesh_bot_instance.interface:
         raise HTTPException(status_code=503, detail="Bot no conectado")
 
-    try:
-        mesh_bot_instance.interface.sendText(
-            text=req.message,
-            destinationId=req.destination_id
+    envio = planificador_tx.texto(
+        req.message, prioridad=PRIORIDAD_NORMAL, esperar_ack=True, destinationId=req.destination_id
+    )
+    if envio.estado == "error":
+        raise HTTPException(status_code=503, detail=envio.error)
+
+    return {
+        "status": "en cola",
+        "id": envio.id,
+        "destination": req.destination_id,
+        "message": req.message
+    }
+
+# ------------------------
+# ENVÍO EN LOTE
+# ------------------------
+
+SEND_BATCH_MAX = 50               # mensajes por pedido
+SEND_BATCH_MAX_CARACTERES = 2000  # por mensaje: unos 10 paquetes de airtime como mucho
+
+
+class BatchMessage(BaseModel):
+    message: str = Field(
+        ...,
+        max_length=SEND_BATCH_MAX_CARACTERES,
+        example="Reporte largo que se parte solo en varios paquetes...",
+        description=(
+            f"Texto UTF-8 de hasta {SEND_BATCH_MAX_CARACTERES} caracteres: se corta en paquetes "
+            "por bytes, en bordes de palabra, conservando saltos de línea"
         )
+    )
+    channel: Optional[int] = Field(None, example=0, description="Canal para broadcast (si no hay destination_id)")
+    destination_id: Optional[str] = Field(None, example="!abcd1234", description="NodeID destino para mensaje directo")
 
-        return {
-            "status": "ok",
-            "destination": req.destination_id,
-            "message": req.message
-        }
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+class SendBatchRequest(BaseModel):
+    messages: List[BatchMessage] = Field(..., description=f"Hasta {SEND_BATCH_MAX} mensajes")
+
+
+@app.post(
+    "/SendBatch",
+    tags=["Mensajería Mesh"],
+    summary="Enviar muchos mensajes o textos largos",
+    status_code=202,
+    description=(
+        "Recibe varios mensajes (a canal o directos) en un solo pedido. Los textos largos se parten "
+        "en paquetes según el límite real de bytes del payload (los emojis ocupan más de un byte). "
+        "Todo el lote se encola de una vez; cada parte tiene su id para /SendStatus/{id}."
+    ),
+    response_description="Ids de las partes encoladas, por mensaje"
+)
+async def send_batch(req: SendBatchRequest):
+    global mesh_bot_instance
+
+    if not mesh_bot_instance or not mesh_bot_instance.interface:
+        raise HTTPException(status_code=503, detail="Bot no conectado")
+    if not req.messages or len(req.messages) > SEND_BATCH_MAX:
+        raise HTTPException(status_code=422, detail=f"Entre 1 y {SEND_BATCH_MAX} mensajes por pedido")
+
+    pedidos = []
+    partes_por_mensaje = []
+    for m in req.messages:
+        partes = partir_texto(m.message)
+        if not partes:
+            raise HTTPException(status_code=422, detail="Mensaje vacío")
+        for parte in partes:
+            if m.destination_id:
+                pedidos.append(planificador_tx.pedido_texto(
+                    parte, prioridad=PRIORIDAD_NORMAL, esperar_ack=True, destinationId=m.destination_id
+                ))
+            else:
+                pedidos.append(planificador_tx.pedido_texto(
+                    parte, prioridad=PRIORIDAD_BULK, channelIndex=m.channel or 0
+                ))
+        partes_por_mensaje.append(len(partes))
+
+    envios = planificador_tx.encolar_lote(pedidos)
+    if envios and envios[0].estado == "error":
+        raise HTTPException(status_code=503, detail=envios[0].error)
+
+    resultado = []
+    inicio = 0
+    for i, n in enumerate(partes_por_mensaje):
+        resultado.append({"indice": i, "partes": n, "ids": [e.id for e in envios[inicio:inicio + n]]})
+        inicio += n
+    return {"status": "en cola", "paquetes": len(envios), "mensajes": resultado}
+
 
 # ------------------------
 # WEATHER TELEMETRY ENDPOINT
@@ -177,7 +390,8 @@ class WeatherTelemetryRequest(BaseModel):
         "a la red Meshtastic como paquete EnvironmentMetrics. "
         "enviar uno por hora"
     ),
-    response_description="Confirmación con las métricas enviadas"
+    status_code=202,
+    response_description="Id del envío encolado con las métricas"
 )
 async def send_weather_telemetry(req: WeatherTelemetryRequest):
     global mesh_bot_instance
@@ -193,11 +407,14 @@ async def send_weather_telemetry(req: WeatherTelemetryRequest):
         telemetry.environment_metrics.relative_humidity   = req.relative_humidity
         telemetry.environment_metrics.barometric_pressure = req.barometric_pressure
         payload = telemetry.SerializeToString()
-        mesh_bot_instance.interface.sendData(
-            data=payload,
+        envio = planificador_tx.datos(
+            payload,
+            prioridad=PRIORIDAD_BULK,
             portNum=portnums_pb2.PortNum.TELEMETRY_APP,
             wantAck=False
         )
+        if envio.estado == "error":
+            raise HTTPException(status_code=503, detail=envio.error)
 
         logging.getLogger("MeshBot").info(
             f"{Fore.CYAN}{Style.BRIGHT}{'Weather Telemetry':<18}{Style.RESET_ALL} "
@@ -206,7 +423,8 @@ async def send_weather_telemetry(req: WeatherTelemetryRequest):
         )
 
         return {
-            "status": "Telemetría enviada",
+            "status": "Telemetría en cola",
+            "id": envio.id,
             "metrics": {
                 "temperature": req.temperature,
                 "relative_humidity": req.relative_humidity,
@@ -214,59 +432,1518 @@ async def send_weather_telemetry(req: WeatherTelemetryRequest):
             }
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get(
+    "/SendStatus/{envio_id}",
+    tags=["Mensajería Mesh"],
+    summary="Estado de un envío",
+    description=(
+        "Estado de un envío encolado por /SendMessage, /SendDirectMessage o /SendWeatherTelemetry: "
+        "en_cola, enviado (entregado a la radio), retransmitido (ACK implícito: un vecino lo "
+        "repitió), confirmado (ACK del nodo destino, solo mensajes directos) o error."
+    ),
+    response_description="Estado del envío y marcas de tiempo"
+)
+async def send_status(envio_id: str):
+    envio = planificador_tx.buscar(envio_id)
+    if envio is None:
+        raise HTTPException(status_code=404, detail="Envío desconocido o demasiado viejo")
+    return envio.a_dict()
+
+
+# ------------------------
+# ESTADO DEL SPOOL
+# ------------------------
+
+@app.get(
+    "/SpoolStatus",
+    tags=["Base de datos"],
+    summary="Estado del spool local",
+    description=(
+        "Eventos guardados localmente mientras MySQL no estuvo disponible "
+        "y progreso del reenvío."
+    ),
+    response_description="Pendientes, reenviados y último error"
+)
+async def spool_status():
+    return spool_local.estado()
+
+
+# ------------------------
+# ESTADO DE COMANDOS
+# ------------------------
+
+@app.get(
+    "/CommandStatus",
+    tags=["Comandos"],
+    summary="Estado de la cola de comandos",
+    description="Comandos en cola, en ejecución, rechazados por cola llena y vencidos por timeout, más aciertos del cache y latencia de las APIs upstream.",
+    response_description="Profundidad de la cola y contadores"
+)
+async def command_status():
+    return {
+        **ejecutor_comandos.estado(),
+        "cache": cache_respuestas.estado(),
+        "upstream": cliente_http.estado(),
+        "comandos": registro_comandos.estado(),
+    }
+
+
+# ------------------------
+# ESTADO DE TRANSMISIÓN
+# ------------------------
+
+@app.get(
+    "/TxStatus",
+    tags=["Mensajería Mesh"],
+    summary="Estado de la cola de transmisión",
+    description="Mensajes esperando por prioridad y airtime disponible en el token bucket.",
+    response_description="Cola por prioridad y contadores de envío"
+)
+async def tx_status():
+    return planificador_tx.estado()
+
+
+# ------------------------
+# ESTADO DE LA CONEXIÓN
+# ------------------------
+
+@app.get(
+    "/ConnectionStatus",
+    tags=["Mensajería Mesh"],
+    summary="Estado de la conexión con la radio",
+    description=(
+        "Nodo actual y candidatos, desde cuándo está conectado y los últimos cortes "
+        "con su duración, nodo de failover y paquetes perdidos estimados."
+    ),
+    response_description="Conexión actual e historial de cortes"
+)
+async def connection_status():
+    return supervisor_conexion.estado()
+
+
+@app.get(
+    "/Radios",
+    tags=["Mensajería Mesh"],
+    summary="Estado de todas las radios",
+    description=(
+        "La radio principal y las de escucha (RADIOS_ESCUCHA): conexión, paquetes oídos "
+        "por cada una y sus cortes."
+    ),
+    response_description="Una entrada por radio"
+)
+async def radios():
+    return flota_radios.estado()
+
+
+# ------------------------
+# MÉTRICAS (Prometheus)
+# ------------------------
+
+# Contadores e histogramas sin lock en el camino caliente: cada hilo suma en su
+# propio dict y /metrics suma los de todos los hilos al leer. Las profundidades
+# de cola se leen recién cuando alguien consulta /metrics.
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_LOTE = (1, 5, 10, 25, 50, 100, 200, 500)
+BUCKETS_ETAPA = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+ETAPAS_ON_RECEIVE = True    # tiempo por etapa de on_receive (dedup, etiquetas, decodificación, log, encolado)
+
+
+def _etiquetas_prom(nombres, valores, le=None):
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    if le is not None:
+        pares.append(f'le="{le}"')
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class Metricas:
+    """Registro mínimo de métricas con salida en formato de texto de Prometheus."""
+
+    def __init__(self, prefijo="midoluz"):
+        self.prefijo = prefijo
+        self._definiciones = OrderedDict()   # nombre -> (tipo, ayuda, etiquetas, buckets o función)
+        self._local = threading.local()
+        self._shards = []                    # (hilo, shard) de los hilos que escribieron
+        self._retirados = {}                 # lo acumulado por hilos que ya terminaron
+        self._lock = threading.Lock()
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        self._definiciones[nombre] = ("counter", ayuda, etiquetas, None)
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        self._definiciones[nombre] = ("histogram", ayuda, etiquetas, buckets)
+
+    def gauge(self, nombre, ayuda, funcion, etiqueta=None):
+        """funcion() se llama al exportar; con etiqueta devuelve {valor de la etiqueta: valor}."""
+        self._definiciones[nombre] = ("gauge", ayuda, (etiqueta,) if etiqueta else (), funcion)
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                # Hilos de vida corta (refrescos del cache, calentado HTTP) no dejan shards colgados
+                self._retirar_muertos()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    @staticmethod
+    def _acumular(total, shard):
+        for clave, valor in list(shard.items()):
+            if isinstance(valor, list):
+                previo = total.get(clave)
+                total[clave] = [a + b for a, b in zip(previo, valor)] if previo else list(valor)
+            else:
+                total[clave] = total.get(clave, 0) + valor
+
+    def _retirar_muertos(self):
+        """Con el lock tomado: pasa a _retirados los shards de hilos terminados (ya nadie los escribe)."""
+        vivos = []
+        for hilo, shard in self._shards:
+            if hilo.is_alive():
+                vivos.append((hilo, shard))
+            else:
+                self._acumular(self._retirados, shard)
+        self._shards = vivos
+
+    def inc(self, nombre, *etiquetas, valor=1):
+        shard = self._shard()
+        clave = (nombre, etiquetas)
+        shard[clave] = shard.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, *etiquetas):
+        buckets = self._definiciones[nombre][3]
+        shard = self._shard()
+        clave = (nombre, etiquetas)
+        h = shard.get(clave)
+        if h is None:
+            # Una cuenta por bucket, una para +Inf y la suma al final
+            h = shard[clave] = [0] * (len(buckets) + 1) + [0.0]
+        h[bisect.bisect_left(buckets, valor)] += 1
+        h[-1] += valor
+
+    def _sumar(self):
+        total = {}
+        with self._lock:
+            self._retirar_muertos()
+            shards = [shard for _, shard in self._shards]
+            self._acumular(total, self._retirados)
+        for shard in shards:
+            self._acumular(total, shard)
+        return total
+
+    def exportar(self):
+        por_nombre = defaultdict(list)
+        for (nombre, valores), valor in self._sumar().items():
+            por_nombre[nombre].append((valores, valor))
+
+        lineas = []
+        for nombre, (tipo, ayuda, etiquetas, extra) in self._definiciones.items():
+            completo = f"{self.prefijo}_{nombre}"
+            lineas.append(f"# HELP {completo} {ayuda}")
+            lineas.append(f"# TYPE {completo} {tipo}")
+            if tipo == "gauge":
+                try:
+                    valor = extra()
+                except Exception:
+                    continue
+                if etiquetas:
+                    for etiqueta, v in valor.items():
+                        lineas.append(f"{completo}{_etiquetas_prom(etiquetas, (etiqueta,))} {v}")
+                else:
+                    lineas.append(f"{completo} {valor}")
+            elif tipo == "counter":
+                for valores, valor in sorted(por_nombre[nombre]):
+                    lineas.append(f"{completo}{_etiquetas_prom(etiquetas, valores)} {valor}")
+            else:
+                for valores, cuentas in sorted(por_nombre[nombre]):
+                    acumulado = 0
+                    for limite, cuenta in zip(list(extra) + ["+Inf"], cuentas[:-1]):
+                        acumulado += cuenta
+                        lineas.append(f"{completo}_bucket{_etiquetas_prom(etiquetas, valores, limite)} {acumulado}")
+                    lineas.append(f"{completo}_sum{_etiquetas_prom(etiquetas, valores)} {cuentas[-1]}")
+                    lineas.append(f"{completo}_count{_etiquetas_prom(etiquetas, valores)} {acumulado}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = Metricas()
+
+metricas.contador("paquetes_recibidos_total", "Paquetes recibidos por portnum (sin duplicados)", ("portnum",))
+metricas.contador("paquetes_duplicados_total", "Copias repetidas descartadas por el índice de duplicados")
+metricas.contador("paquetes_primera_copia_total", "Paquetes que cada radio entregó antes que las demás", ("radio",))
+metricas.histograma("on_receive_etapa_segundos", "Duración de cada etapa de on_receive", ("etapa",),
+                    buckets=BUCKETS_ETAPA)
+metricas.histograma("serializacion_json_segundos", "Duración de serializar un lote de eventos a JSON",
+                    buckets=BUCKETS_ETAPA)
+metricas.histograma("db_insert_segundos", "Duración de cada insert en lote", ("tabla",))
+metricas.histograma("db_lote_filas", "Filas por lote insertado", ("tabla",), buckets=BUCKETS_LOTE)
+metricas.contador("db_errores_total", "Lotes que MySQL no aceptó", ("tabla",))
+metricas.contador("filas_tipadas_perdidas_total", "Filas de tablas tipadas y rollups descartadas por error de MySQL o cola llena (no pasan por el spool)", ("tabla",))
+metricas.histograma("comando_segundos", "Duración de cada comando, cache incluido", ("comando",))
+metricas.contador("comando_errores_total", "Comandos que terminaron con excepción", ("comando",))
+metricas.contador("comandos_descartados_total", "Comandos no atendidos", ("motivo",))
+metricas.histograma("upstream_segundos", "Latencia de las APIs externas", ("endpoint",))
+metricas.contador("upstream_errores_total", "Requests a APIs externas que fallaron", ("endpoint",))
+metricas.contador("envios_total", "Paquetes entregados a la radio por resultado", ("metodo", "resultado"))
+metricas.contador("reconexiones_total", "Intentos de reconexión al nodo", ("radio", "resultado"))
+metricas.histograma("corte_segundos", "Duración de cada corte de conexión con la radio", ("radio",),
+                    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+metricas.contador("paquetes_perdidos_estimados_total", "Paquetes estimados perdidos durante cortes", ("radio",))
+metricas.gauge("cola_profundidad", "Elementos esperando en cada cola", lambda: {
+    "escritor_db": escritor_db.cola.qsize(),
+    "comandos": ejecutor_comandos.cola.qsize(),
+    "transmision": sum(planificador_tx.estado()["en_cola"].values()),
+    "log": _listener_log.queue.qsize() if _listener_log else 0,
+}, etiqueta="cola")
+metricas.gauge("conectado", "1 si hay conexión con la radio", lambda: {
+    supervisor.nombre: int(supervisor.estado()["conectado"]) for supervisor in flota_radios.supervisores()
+}, etiqueta="radio")
+metricas.gauge("paquetes_por_radio", "Paquetes oídos por cada radio desde el arranque, copias repetidas incluidas", lambda: {
+    supervisor.nombre: supervisor.recibidos for supervisor in flota_radios.supervisores()
+}, etiqueta="radio")
+metricas.gauge("log_descartados", "Registros de log descartados por cola llena", lambda: HandlerCola.descartados)
+metricas.gauge("spool_pendientes", "Eventos en el spool local esperando a MySQL",
+               lambda: spool_local.pendientes)
+
+
+@app.get(
+    "/metrics",
+    tags=["Métricas"],
+    summary="Métricas en formato Prometheus",
+    description="Paquetes, base de datos, colas, comandos, APIs externas, envíos y reconexiones.",
+    response_class=PlainTextResponse
+)
+async def metrics():
+    return PlainTextResponse(metricas.exportar(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ------------------------
+# PROFILER POR MUESTREO
+# ------------------------
+
+# Para ver en producción dónde se va el tiempo sin reiniciar el bot: un hilo
+# toma cada tantos ms la pila de todos los hilos (sys._current_frames) y cuenta
+# cuántas veces aparece cada una. La salida es el formato "collapsed" que leen
+# flamegraph.pl y speedscope. Con el profiler apagado no cuesta nada.
+PROFILER_INTERVALO_MS = 10      # período de muestreo
+PROFILER_DURACION_MAX_S = 300   # se apaga solo si nadie lo detiene
+
+
+class ProfilerMuestreo:
+    """Muestrea las pilas de todos los hilos mientras está activo."""
+
+    def __init__(self):
+        self.pilas = defaultdict(int)
+        self.muestras = 0
+        self.inicio = None
+        self.fin = None
+        self.intervalo = PROFILER_INTERVALO_MS / 1000
+        self._detener = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+
+    @property
+    def activo(self):
+        return self._hilo is not None and self._hilo.is_alive()
+
+    def start(self, intervalo_ms=PROFILER_INTERVALO_MS, duracion_s=PROFILER_DURACION_MAX_S):
+        """Empieza una captura nueva; devuelve False si ya hay una en curso."""
+        if self.activo:
+            return False
+        with self._lock:
+            self.pilas = defaultdict(int)
+            self.muestras = 0
+        self.intervalo = intervalo_ms / 1000
+        self.inicio = datetime.now()
+        self.fin = None
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._loop, args=(duracion_s,), name="Profiler", daemon=True)
+        self._hilo.start()
+        return True
+
+    def stop(self):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(2)
+
+    @staticmethod
+    def _pila(frame):
+        partes = []
+        while frame is not None:
+            codigo = frame.f_code
+            partes.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+            frame = frame.f_back
+        partes.reverse()
+        return ";".join(partes)
+
+    def _loop(self, duracion_s):
+        propio = threading.get_ident()
+        limite = time.monotonic() + duracion_s
+        while not self._detener.wait(self.intervalo) and time.monotonic() < limite:
+            nombres = {h.ident: h.name for h in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == propio:
+                        continue
+                    self.pilas[f"{nombres.get(ident, ident)};{self._pila(frame)}"] += 1
+                self.muestras += 1
+        self.fin = datetime.now()
+
+    def colapsadas(self):
+        with self._lock:
+            return "".join(f"{pila} {n}\n" for pila, n in sorted(self.pilas.items()))
+
+    def estado(self, top=15):
+        # Funciones donde más muestras hubo (la hoja de cada pila)
+        hojas = defaultdict(int)
+        with self._lock:
+            for pila, n in self.pilas.items():
+                hojas[pila.rsplit(";", 1)[-1]] += n
+            muestras = self.muestras
+        return {
+            "activo": self.activo,
+            "inicio": self.inicio.isoformat(timespec="seconds") if self.inicio else None,
+            "fin": self.fin.isoformat(timespec="seconds") if self.fin else None,
+            "intervalo_ms": round(self.intervalo * 1000, 1),
+            "muestras": muestras,
+            "pilas_distintas": len(self.pilas),
+            "top": [{"funcion": f, "muestras": n} for f, n in sorted(hojas.items(), key=lambda x: -x[1])[:top]],
+        }
+
+
+profiler_muestreo = ProfilerMuestreo()
+
+
+@app.post(
+    "/ProfilerStart",
+    tags=["Diagnóstico"],
+    summary="Iniciar el profiler por muestreo",
+    description=(
+        "Empieza a muestrear las pilas de todos los hilos. Se detiene con /ProfilerStop "
+        f"o solo después de duracion_s (máximo {PROFILER_DURACION_MAX_S}s). Borra la captura anterior."
+    ),
+    response_description="Estado del profiler"
+)
+async def profiler_start(intervalo_ms: int = PROFILER_INTERVALO_MS, duracion_s: int = 60):
+    if not 1 <= intervalo_ms <= 1000:
+        raise HTTPException(status_code=422, detail="intervalo_ms debe estar entre 1 y 1000")
+    if not 1 <= duracion_s <= PROFILER_DURACION_MAX_S:
+        raise HTTPException(status_code=422, detail=f"duracion_s debe estar entre 1 y {PROFILER_DURACION_MAX_S}")
+    if not profiler_muestreo.start(intervalo_ms, duracion_s):
+        raise HTTPException(status_code=409, detail="El profiler ya está activo")
+    return profiler_muestreo.estado()
+
+
+@app.post(
+    "/ProfilerStop",
+    tags=["Diagnóstico"],
+    summary="Detener el profiler",
+    response_description="Estado del profiler con las funciones más muestreadas"
+)
+async def profiler_stop():
+    profiler_muestreo.stop()
+    return profiler_muestreo.estado()
+
+
+@app.get(
+    "/ProfilerStatus",
+    tags=["Diagnóstico"],
+    summary="Estado del profiler",
+    description="Si está activo, cuántas muestras lleva y las funciones donde más tiempo se pasó.",
+    response_description="Estado del profiler"
+)
+async def profiler_status():
+    return profiler_muestreo.estado()
+
+
+@app.get(
+    "/ProfilerStacks",
+    tags=["Diagnóstico"],
+    summary="Descargar las pilas muestreadas",
+    description="Formato collapsed (una pila por línea con su cantidad de muestras), para flamegraph.pl o speedscope.",
+    response_class=PlainTextResponse
+)
+async def profiler_stacks():
+    return PlainTextResponse(
+        profiler_muestreo.colapsadas(),
+        headers={"Content-Disposition": "attachment; filename=midoluz_stacks.txt"}
+    )
 
 
 def start_rest_api():
-    uvicorn.run(app, host="0.0.0.0", port=1215, log_level="info")
+    # log_config=None: los logs de uvicorn van al logging del bot (cola, consola o JSON)
+    uvicorn.run(app, host="0.0.0.0", port=1215, log_level="info", log_config=None)
 
 
 # ------------------------
 # DB UTILS
 # ------------------------
 
+# Serializador por tipo: el tipo exacto del objeto elige la función en un dict,
+# sin recorrer una cadena de isinstance por cada valor del payload.
+JSON_RAPIDO = True     # usar orjson si está instalado
+
+_ESCALARES = frozenset((int, float, str, bool, type(None)))
+
+
+def _identidad(obj):
+    return obj
+
+
+def _serializar_dict(obj):
+    return {
+        (k if type(k) is str else str(k)): (v if type(v) in _ESCALARES else serializar_para_json(v))
+        for k, v in obj.items()
+    }
+
+
+def _serializar_lista(obj):
+    return [i if type(i) in _ESCALARES else serializar_para_json(i) for i in obj]
+
+
+def _serializar_bytes(obj):
+    return base64.b64encode(obj).decode("ascii")
+
+
+def _serializar_protobuf(obj):
+    # Mismo formato que usa meshtastic para los paquetes decodificados (camelCase, bytes en base64)
+    return MessageToDict(obj)
+
+
+_SERIALIZADORES = {
+    int: _identidad,
+    float: _identidad,
+    str: _identidad,
+    bool: _identidad,
+    type(None): _identidad,
+    dict: _serializar_dict,
+    list: _serializar_lista,
+    tuple: _serializar_lista,
+    bytes: _serializar_bytes,
+    bytearray: _serializar_bytes,
+}
+
+
+def _resolver_serializador(tipo):
+    if issubclass(tipo, ProtoMessage):
+        return _serializar_protobuf
+    for base in (bool, int, float, str, dict, list, tuple, bytes, bytearray):
+        if issubclass(tipo, base):
+            return _SERIALIZADORES[base]
+    return str
+
+
 def serializar_para_json(obj):
-    if isinstance(obj, (int, float, str, bool, type(None))):
-        return obj
-    if isinstance(obj, dict):
-        return {str(k): serializar_para_json(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [serializar_para_json(i) for i in obj]
-    if hasattr(obj, "__dict__"):
-        return str(obj)
-    return str(obj)
+    funcion = _SERIALIZADORES.get(type(obj))
+    if funcion is None:
+        # Tipos nuevos (protobufs, subclases) se resuelven una vez y quedan en la tabla
+        funcion = _SERIALIZADORES[type(obj)] = _resolver_serializador(type(obj))
+    return funcion(obj)
 
 
-def registrar_en_db(tipo, emisor_id, emisor_name, receptor_id, extra_data):
-    try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
+def payload_a_json(obj):
+    data = serializar_para_json(obj)
+    if orjson is not None and JSON_RAPIDO:
+        try:
+            return orjson.dumps(data).decode("utf-8")
+        except (TypeError, orjson.JSONEncodeError):
+            pass    # ej. enteros de más de 64 bits: que lo resuelva json
+    return json.dumps(data)
+
+
+# ------------------------
+# POOL DE CONEXIONES DB
+# ------------------------
 
-        data_limpia = serializar_para_json(extra_data)
+DB_POOL_SIZE = 4           # conexiones abiertas compartidas por todo el bot
+DB_POOL_ESPERA = 5.0       # segundos máximos esperando una conexión libre
+
+
+class PoolDB:
+    """Pool único de conexiones MySQL: valida cada conexión al sacarla y reconecta si MySQL se reinició."""
+
+    def __init__(self, config, tamanio=DB_POOL_SIZE, espera=DB_POOL_ESPERA):
+        self.config = config
+        self.tamanio = tamanio
+        self.espera = espera
+        self.reconexiones = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _obtener_pool(self):
+        # Se crea recién en el primer uso: si MySQL no está al arrancar se reintenta en la próxima llamada
+        with self._lock:
+            if self._pool is None:
+                self._pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="midoluz",
+                    pool_size=self.tamanio,
+                    pool_reset_session=True,
+                    **self.config
+                )
+            return self._pool
+
+    def _sacar(self):
+        limite = time.monotonic() + self.espera
+        while True:
+            try:
+                return self._obtener_pool().get_connection()
+            except mysql.connector.errors.PoolError:
+                # Pool agotado: esperamos a que alguien devuelva una conexión
+                if time.monotonic() >= limite:
+                    raise
+                time.sleep(0.05)
+
+    @contextmanager
+    def conexion(self):
+        conn = self._sacar()
+        try:
+            if not conn.is_connected():
+                self.reconexiones += 1
+                conn.reconnect(attempts=2, delay=1)
+            yield conn
+        finally:
+            # En una conexión del pool, close() la devuelve al pool
+            conn.close()
+
+
+pool_db = PoolDB(DB_CONFIG)
+
+
+# ------------------------
+# TABLAS TIPADAS
+# ------------------------
+
+# Además del JSON en eventos, posición, métricas y nodos se guardan en columnas
+# propias con índice por nodo y fecha, para consultar sin parsear data_json.
+TABLAS_TIPADAS = True
+
+DDL_TABLAS_TIPADAS = [
+    """
+    CREATE TABLE IF NOT EXISTS posiciones (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        fecha_hora DATETIME NOT NULL,
+        nodo_id VARCHAR(20) NOT NULL,
+        latitud DOUBLE,
+        longitud DOUBLE,
+        altitud INT,
+        sats INT,
+        pdop INT,
+        UNIQUE KEY uq_posiciones_nodo_fecha (nodo_id, fecha_hora)
+    ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS metricas_dispositivo (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        fecha_hora DATETIME NOT NULL,
+        nodo_id VARCHAR(20) NOT NULL,
+        voltaje FLOAT,
+        bateria INT,
+        utilizacion_canal FLOAT,
+        air_util_tx FLOAT,
+        uptime_s INT UNSIGNED,
+        UNIQUE KEY uq_metricas_nodo_fecha (nodo_id, fecha_hora)
+    ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS nodos (
+        nodo_id VARCHAR(20) PRIMARY KEY,
+        short_name VARCHAR(50),
+        long_name VARCHAR(100),
+        hw_model VARCHAR(50),
+        primera_vez DATETIME,
+        ultima_vez DATETIME,
+        INDEX idx_nodos_ultima_vez (ultima_vez)
+    ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollups (
+        nodo_id VARCHAR(20) NOT NULL,
+        metrica VARCHAR(30) NOT NULL,
+        granularidad ENUM('1m', '1h', '1d') NOT NULL,
+        bucket DATETIME NOT NULL,
+        minimo DOUBLE,
+        maximo DOUBLE,
+        suma DOUBLE,
+        cantidad INT UNSIGNED,
+        PRIMARY KEY (nodo_id, metrica, granularidad, bucket),
+        INDEX idx_rollups_granularidad_bucket (granularidad, bucket)
+    ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+    """,
+]
+
+# INSERT IGNORE sobre (nodo_id, fecha_hora): el backfill se puede correr varias
+# veces, o mientras el bot está vivo, sin duplicar filas.
+QUERIES_TIPADAS = {
+    "posiciones": """
+        INSERT IGNORE INTO posiciones (fecha_hora, nodo_id, latitud, longitud, altitud, sats, pdop)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """,
+    "metricas_dispositivo": """
+        INSERT IGNORE INTO metricas_dispositivo
+            (fecha_hora, nodo_id, voltaje, bateria, utilizacion_canal, air_util_tx, uptime_s)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """,
+    # Los nombres solo se pisan con datos más nuevos; ultima_vez va al final
+    # porque MySQL aplica las asignaciones en orden.
+    "nodos": """
+        INSERT INTO nodos (nodo_id, short_name, long_name, hw_model, primera_vez, ultima_vez)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            short_name = IF(VALUES(ultima_vez) >= ultima_vez, VALUES(short_name), short_name),
+            long_name = IF(VALUES(ultima_vez) >= ultima_vez, VALUES(long_name), long_name),
+            hw_model = IF(VALUES(ultima_vez) >= ultima_vez, VALUES(hw_model), hw_model),
+            primera_vez = LEAST(primera_vez, VALUES(primera_vez)),
+            ultima_vez = GREATEST(ultima_vez, VALUES(ultima_vez))
+    """,
+    # Aditivo: el promedio es suma / cantidad
+    "rollups": """
+        INSERT INTO rollups (nodo_id, metrica, granularidad, bucket, minimo, maximo, suma, cantidad)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            minimo = LEAST(minimo, VALUES(minimo)),
+            maximo = GREATEST(maximo, VALUES(maximo)),
+            suma = suma + VALUES(suma),
+            cantidad = cantidad + VALUES(cantidad)
+    """,
+}
+
+
+def filas_tipadas(tipo, nodo_id, fecha, payload):
+    """Devuelve [(tabla, fila)] para los paquetes que tienen tabla propia. La usa el bot y el backfill."""
+    if tipo == "POSITION_APP":
+        if payload.get("latitude") is None or payload.get("longitude") is None:
+            return []
+        return [("posiciones", (
+            fecha, nodo_id, payload["latitude"], payload["longitude"],
+            payload.get("altitude"), payload.get("sats"), payload.get("PDOP")
+        ))]
+    if tipo == "TELEMETRY_APP":
+        # Solo deviceMetrics: la telemetría ambiental llega con el dict vacío
+        if not payload or (payload.get("voltage") is None and payload.get("batteryLevel") is None):
+            return []
+        return [("metricas_dispositivo", (
+            fecha, nodo_id, payload.get("voltage"), payload.get("batteryLevel"),
+            payload.get("channelUtilization"), payload.get("airUtilTx"), payload.get("uptimeSeconds")
+        ))]
+    if tipo == "NODEINFO_APP":
+        if not payload.get("shortName") and not payload.get("longName"):
+            return []
+        return [("nodos", (
+            nodo_id, payload.get("shortName"), payload.get("longName"),
+            str(payload["hwModel"]) if payload.get("hwModel") is not None else None, fecha, fecha
+        ))]
+    return []
+
+
+def crear_tablas_tipadas(cursor):
+    for ddl in DDL_TABLAS_TIPADAS:
+        cursor.execute(ddl)
+
+
+def insertar_filas_tipadas(cursor, filas):
+    """filas: iterable de (tabla, fila). Un executemany por tabla."""
+    por_tabla = defaultdict(list)
+    for tabla, fila in filas:
+        por_tabla[tabla].append(fila)
+    for tabla, valores in por_tabla.items():
+        cursor.executemany(QUERIES_TIPADAS[tabla], valores)
+    return {tabla: len(valores) for tabla, valores in por_tabla.items()}
+
+
+# ------------------------
+# ROLLUPS DE TELEMETRÍA
+# ------------------------
+
+# Mínimo, máximo, promedio y cantidad por nodo y métrica, en baldes de 1 minuto,
+# 1 hora y 1 día. Se acumulan en memoria a medida que llegan los paquetes y se
+# suman a la tabla rollups cada ROLLUP_FLUSH_INTERVALO segundos (upsert aditivo,
+# así un mismo balde puede recibir varios flushes).
+ROLLUPS = True
+ROLLUP_FLUSH_INTERVALO = 60.0
+
+GRANULARIDADES = ("1m", "1h", "1d")
+
+# tabla tipada -> (métrica, posición en la fila de filas_tipadas)
+METRICAS_ROLLUP = {
+    "posiciones": (("latitud", 2), ("longitud", 3), ("altitud", 4)),
+    "metricas_dispositivo": (("voltaje", 2), ("bateria", 3), ("utilizacion_canal", 4), ("air_util_tx", 5)),
+}
+
+# Retención: los datos crudos y los baldes finos se borran pasado este plazo.
+# Los crudos solo si el balde diario de ese nodo y día ya existe en rollups.
+RETENCION_DIAS = {"crudos": 30, "1m": 30, "1h": 365}
+RETENCION_PODAR_EVENTOS = False   # también borrar de eventos POSITION/TELEMETRY (incluye telemetría ambiental, que no tiene rollup)
+RETENCION_INTERVALO = 6 * 3600.0
+RETENCION_LOTE = 5000             # filas por DELETE, para no bloquear los INSERT del bot
+
+_DIA_ROLLUP = "(SELECT nodo_id, DATE(bucket) FROM rollups WHERE granularidad = '1d')"
+
+PODAS_RETENCION = [
+    ("1m", "DELETE FROM rollups WHERE granularidad = '1m' AND bucket < %s LIMIT %s"),
+    ("1h", "DELETE FROM rollups WHERE granularidad = '1h' AND bucket < %s LIMIT %s"),
+    ("crudos", f"DELETE FROM posiciones WHERE fecha_hora < %s AND (nodo_id, DATE(fecha_hora)) IN {_DIA_ROLLUP} LIMIT %s"),
+    ("crudos", f"DELETE FROM metricas_dispositivo WHERE fecha_hora < %s AND (nodo_id, DATE(fecha_hora)) IN {_DIA_ROLLUP} LIMIT %s"),
+]
+PODA_EVENTOS = (
+    "crudos",
+    f"DELETE FROM eventos WHERE fecha_hora < %s AND tipo_paquete IN ('POSITION_APP', 'TELEMETRY_APP') "
+    f"AND (emisor_id, DATE(fecha_hora)) IN {_DIA_ROLLUP} LIMIT %s"
+)
+
+
+def inicio_balde(fecha, granularidad):
+    if granularidad == "1m":
+        return fecha.replace(second=0, microsecond=0)
+    if granularidad == "1h":
+        return fecha.replace(minute=0, second=0, microsecond=0)
+    return fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class AgregadorRollups:
+    """Acumula (nodo, métrica, granularidad, balde) -> [min, max, suma, cantidad] y lo vuelca en lote."""
+
+    def __init__(self, intervalo=ROLLUP_FLUSH_INTERVALO):
+        self.intervalo = intervalo
+        self.filas_podadas = 0
+        self._acum = {}
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilos = []
+
+    def agregar(self, tabla, fila):
+        metricas = METRICAS_ROLLUP.get(tabla)
+        if not metricas:
+            return
+        fecha, nodo_id = fila[0], fila[1]
+        baldes = [(g, inicio_balde(fecha, g)) for g in GRANULARIDADES]
+        with self._lock:
+            for metrica, pos in metricas:
+                valor = fila[pos]
+                if valor is None:
+                    continue
+                for granularidad, balde in baldes:
+                    clave = (nodo_id, metrica, granularidad, balde)
+                    acc = self._acum.get(clave)
+                    if acc is None:
+                        self._acum[clave] = [valor, valor, valor, 1]
+                    else:
+                        if valor < acc[0]: acc[0] = valor
+                        if valor > acc[1]: acc[1] = valor
+                        acc[2] += valor
+                        acc[3] += 1
+
+    def filas(self):
+        """Vacía lo acumulado y lo devuelve como [("rollups", fila)] para QUERIES_TIPADAS."""
+        with self._lock:
+            acum, self._acum = self._acum, {}
+        return [("rollups", (*clave, *valores)) for clave, valores in acum.items()]
+
+    def volcar(self):
+        filas = self.filas()
+        for fila in filas:
+            escritor_db.encolar(fila)
+        return len(filas)
+
+    def podar(self):
+        """Borra por bloques de RETENCION_LOTE con commit entre cada uno: nunca un DELETE grande."""
+        ahora = datetime.now()
+        podas = PODAS_RETENCION + ([PODA_EVENTOS] if RETENCION_PODAR_EVENTOS else [])
+        for clave, query in podas:
+            limite = ahora - timedelta(days=RETENCION_DIAS[clave])
+            while not self._detener.is_set():
+                with pool_db.conexion() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(query, (limite, RETENCION_LOTE))
+                    borradas = cursor.rowcount
+                    conn.commit()
+                    cursor.close()
+                self.filas_podadas += borradas
+                if borradas < RETENCION_LOTE:
+                    break
+                time.sleep(0.2)
+
+    def start(self):
+        for objetivo, nombre in ((self._loop_volcado, "RollupsVolcado"), (self._loop_retencion, "RollupsRetencion")):
+            hilo = threading.Thread(target=objetivo, name=nombre, daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def stop(self):
+        self._detener.set()
+        # Lo acumulado tiene que entrar en la cola antes de que escritor_db haga su último flush
+        self.volcar()
+
+    def _loop_volcado(self):
+        while not self._detener.wait(self.intervalo):
+            self.volcar()
+
+    def _loop_retencion(self):
+        while not self._detener.wait(RETENCION_INTERVALO):
+            try:
+                self.podar()
+            except Exception as e:
+                logging.getLogger("MeshBot").error(f"Error en retención de datos crudos: {e}")
+
+
+agregador_rollups = AgregadorRollups()
 
-        query = """
-            INSERT INTO eventos (tipo_paquete, emisor_id, emisor_name, receptor_id, data_json)
-            VALUES (%s, %s, %s, %s, %s)
+
+# ------------------------
+# MANTENIMIENTO DE EVENTOS
+# ------------------------
+
+# eventos se particiona por mes sobre fecha_hora: borrar un mes viejo es un
+# DROP PARTITION (instantáneo) y no un DELETE enorme que bloquea la tabla.
+# Un hilo del bot crea las particiones de los meses que vienen y tira las
+# vencidas una vez por día. La conversión inicial de la tabla se hace a mano:
+#   python3 midoluzbotv4.py --mantenimiento --migrar
+EVENTOS_RETENCION_MESES = 12      # None: no borrar nunca
+EVENTOS_PARTICIONES_ADELANTE = 3  # meses futuros con partición ya creada
+MANTENIMIENTO_INTERVALO = 24 * 3600.0
+MANTENIMIENTO_LOCK_WAIT = 5       # segundos: si el ALTER no consigue el lock, se abandona
+
+# Índices que usan las consultas del bot, el backfill y la retención
+INDICES_EVENTOS = {
+    "idx_eventos_fecha": "(fecha_hora)",
+    "idx_eventos_tipo_fecha": "(tipo_paquete, fecha_hora)",
+    "idx_eventos_emisor_fecha": "(emisor_id, fecha_hora)",
+}
+
+
+def _primer_dia_mes(fecha, meses=0):
+    total = fecha.year * 12 + fecha.month - 1 + meses
+    return datetime(total // 12, total % 12 + 1, 1)
+
+
+class MantenimientoEventos:
+    """Particiones mensuales de eventos: crea las que faltan, borra las vencidas y agrega índices."""
+
+    def __init__(self, intervalo=MANTENIMIENTO_INTERVALO):
+        self.intervalo = intervalo
+        self.ultima_corrida = None
+        self._detener = threading.Event()
+        self._hilo = None
+
+    @contextmanager
+    def _cursor(self):
+        with pool_db.conexion() as conn:
+            cursor = conn.cursor()
+            # Un ALTER esperando el metadata lock frena a todos los INSERT que
+            # llegan detrás: mejor rendirse rápido y reintentar la próxima vez.
+            cursor.execute("SET SESSION lock_wait_timeout = %s", (MANTENIMIENTO_LOCK_WAIT,))
+            try:
+                yield cursor
+                conn.commit()
+            finally:
+                # Si la conexión murió esto también falla: que no tape el error original
+                try:
+                    cursor.execute("SET SESSION lock_wait_timeout = DEFAULT")
+                except Exception as e:
+                    logging.getLogger("MeshBot").warning(f"No se pudo restaurar lock_wait_timeout: {e}")
+                finally:
+                    cursor.close()
+
+    def particiones(self, cursor):
+        """[(nombre, limite superior o None si es MAXVALUE)] en orden."""
+        cursor.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'eventos' AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """)
+        resultado = []
+        for nombre, descripcion in cursor.fetchall():
+            limite = None
+            if descripcion and descripcion != "MAXVALUE":
+                limite = datetime.strptime(descripcion.strip("'")[:10], "%Y-%m-%d")
+            resultado.append((nombre, limite))
+        return resultado
+
+    def asegurar_indices(self, cursor):
+        cursor.execute("""
+            SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'eventos'
+        """)
+        existentes = {fila[0] for fila in cursor.fetchall()}
+        faltantes = [f"ADD INDEX {nombre} {columnas}" for nombre, columnas in INDICES_EVENTOS.items()
+                     if nombre not in existentes]
+        if faltantes:
+            cursor.execute(f"ALTER TABLE eventos {', '.join(faltantes)}, ALGORITHM=INPLACE, LOCK=NONE")
+        return len(faltantes)
+
+    def migrar(self):
+        """Conversión única a tabla particionada. Reescribe la tabla: correr en un horario tranquilo."""
+        with pool_db.conexion() as conn:
+            cursor = conn.cursor()
+            if self.particiones(cursor):
+                cursor.close()
+                return False
+            # El mes actual y los que vienen ya quedan creados: p_futuro arranca
+            # vacía y partirla después no copia filas
+            historico = _primer_dia_mes(datetime.now())
+            meses = []
+            for i in range(EVENTOS_PARTICIONES_ADELANTE + 1):
+                desde, hasta = _primer_dia_mes(historico, i), _primer_dia_mes(historico, i + 1)
+                meses.append(f"PARTITION p{desde:%Y%m} VALUES LESS THAN ('{hasta:%Y-%m-%d}')")
+            cursor.execute(f"""
+                ALTER TABLE eventos
+                    MODIFY fecha_hora DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    DROP PRIMARY KEY,
+                    ADD PRIMARY KEY (id, fecha_hora)
+                PARTITION BY RANGE COLUMNS (fecha_hora) (
+                    PARTITION p_historico VALUES LESS THAN ('{historico:%Y-%m-%d}'),
+                    {", ".join(meses)},
+                    PARTITION p_futuro VALUES LESS THAN (MAXVALUE)
+                )
+            """)
+            conn.commit()
+            cursor.close()
+        return True
+
+    @staticmethod
+    def _futuro_vacia(cursor):
+        cursor.execute("SELECT 1 FROM eventos PARTITION (p_futuro) LIMIT 1")
+        return not cursor.fetchall()
+
+    def asegurar_particiones(self, cursor, particiones, forzar=False):
+        """Parte p_futuro para sumar los meses que vienen.
+
+        Con p_futuro vacía el REORGANIZE no mueve filas. Si tiene filas (el bot
+        estuvo parado más allá de la última partición) el ALTER las copia y frena
+        los INSERT mientras dura: no se hace salvo con forzar (corrida a mano).
         """
+        limites = [limite for _, limite in particiones if limite]
+        ultimo = max(limites) if limites else _primer_dia_mes(datetime.now())
+        objetivo = _primer_dia_mes(datetime.now(), EVENTOS_PARTICIONES_ADELANTE + 1)
+        creadas = 0
+        if ultimo < objetivo and not forzar and not self._futuro_vacia(cursor):
+            logging.getLogger("MeshBot").warning(
+                "p_futuro de eventos tiene filas: no se crean particiones para no bloquear los INSERT. "
+                "Correr en un horario tranquilo: python3 midoluzbotv4.py --mantenimiento --forzar"
+            )
+            return 0
+        while ultimo < objetivo:
+            siguiente = _primer_dia_mes(ultimo, 1)
+            cursor.execute(f"""
+                ALTER TABLE eventos REORGANIZE PARTITION p_futuro INTO (
+                    PARTITION p{ultimo:%Y%m} VALUES LESS THAN ('{siguiente:%Y-%m-%d}'),
+                    PARTITION p_futuro VALUES LESS THAN (MAXVALUE)
+                )
+            """)
+            ultimo = siguiente
+            creadas += 1
+        return creadas
+
+    def eliminar_vencidas(self, cursor, particiones):
+        if EVENTOS_RETENCION_MESES is None:
+            return []
+        corte = _primer_dia_mes(datetime.now(), -EVENTOS_RETENCION_MESES)
+        vencidas = [nombre for nombre, limite in particiones if limite and limite <= corte]
+        if vencidas:
+            cursor.execute(f"ALTER TABLE eventos DROP PARTITION {', '.join(vencidas)}")
+        return vencidas
+
+    def podar_sin_particiones(self, cursor):
+        """Tabla todavía sin migrar: DELETE por bloques usando el índice de fecha."""
+        if EVENTOS_RETENCION_MESES is None:
+            return 0
+        corte = _primer_dia_mes(datetime.now(), -EVENTOS_RETENCION_MESES)
+        total = 0
+        while not self._detener.is_set():
+            cursor.execute("DELETE FROM eventos WHERE fecha_hora < %s LIMIT %s", (corte, RETENCION_LOTE))
+            borradas = cursor.rowcount
+            cursor.execute("COMMIT")
+            total += borradas
+            if borradas < RETENCION_LOTE:
+                break
+            time.sleep(0.2)
+        return total
+
+    def correr(self, forzar=False):
+        log = logging.getLogger("MeshBot")
+        with self._cursor() as cursor:
+            indices = self.asegurar_indices(cursor)
+            particiones = self.particiones(cursor)
+            if particiones:
+                creadas = self.asegurar_particiones(cursor, particiones, forzar)
+                vencidas = self.eliminar_vencidas(cursor, self.particiones(cursor))
+                log.info(
+                    f"Mantenimiento eventos: {creadas} particiones nuevas, "
+                    f"borradas {vencidas or 'ninguna'}, {indices} índices agregados"
+                )
+            else:
+                borradas = self.podar_sin_particiones(cursor)
+                log.info(f"Mantenimiento eventos (sin particiones): {borradas} filas borradas, {indices} índices agregados")
+        self.ultima_corrida = datetime.now()
 
-        valores = (
-            tipo,
-            emisor_id,
-            emisor_name,
-            receptor_id,
-            json.dumps(data_limpia)
-        )
+    def start(self):
+        self._hilo = threading.Thread(target=self._loop, name="MantenimientoEventos", daemon=True)
+        self._hilo.start()
 
-        cursor.execute(query, valores)
-        conn.commit()
-        cursor.close()
-        conn.close()
+    def stop(self):
+        self._detener.set()
 
-    except Exception as e:
-        print(f"{Fore.RED}[DB ERROR] {e}{Style.RESET_ALL}")
+    def _loop(self):
+        # Primera corrida un rato después de arrancar, para no competir con la reconexión
+        espera = 300.0
+        while not self._detener.wait(espera):
+            try:
+                self.correr()
+            except Exception as e:
+                logging.getLogger("MeshBot").error(f"Error en mantenimiento de eventos: {e}")
+            espera = self.intervalo
+
+
+mantenimiento_eventos = MantenimientoEventos()
+
+
+# ------------------------
+# ESCRITOR DB EN LOTE
+# ------------------------
+
+# on_receive corre en el hilo lector de meshtastic: no puede esperar a MySQL.
+# Los eventos se encolan y un hilo aparte los inserta en lote con un solo commit.
+# Cada elemento de la cola es (tabla, fila): "eventos" o una de QUERIES_TIPADAS.
+DB_BATCH_MAX = 100         # filas por INSERT multi-fila
+DB_BATCH_INTERVALO = 2.0   # segundos máximos que una fila espera en la cola
+DB_COLA_MAX = 10000        # tope de la cola: si se llena se descartan eventos
+
+QUERY_INSERT_EVENTO = """
+    INSERT INTO eventos (fecha_hora, tipo_paquete, emisor_id, emisor_name, receptor_id, data_json)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+
+class EscritorDB:
+    """Drena la cola de eventos y los guarda con executemany + un commit por lote."""
+
+    def __init__(self, batch_max=DB_BATCH_MAX, intervalo=DB_BATCH_INTERVALO, cola_max=DB_COLA_MAX):
+        self.batch_max = batch_max
+        self.intervalo = intervalo
+        self.cola = queue.Queue(maxsize=cola_max)
+        self.descartados = 0
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def start(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._loop, name="EscritorDB", daemon=True)
+        self._hilo.start()
+
+    def stop(self, timeout=10):
+        """Pide al hilo que vacíe la cola, haga el último flush y termine.
+
+        Al volver, todo lo encolado antes ya pasó por _flush (salvo que venza timeout).
+        """
+        self._detener.set()
+        try:
+            # Despierta al hilo para que no espere el intervalo del lote a medio llenar
+            self.cola.put_nowait(None)
+        except queue.Full:
+            pass
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def encolar(self, fila):
+        try:
+            self.cola.put_nowait(fila)
+            return True
+        except queue.Full:
+            self.descartados += 1
+            return False
+
+    def _loop(self):
+        lote = []
+        limite = None
+        while True:
+            espera = self.intervalo if limite is None else max(0.0, limite - time.monotonic())
+            try:
+                fila = self.cola.get(timeout=espera)
+                if fila is not None:
+                    if limite is None:
+                        limite = time.monotonic() + self.intervalo
+                    lote.append(fila)
+            except queue.Empty:
+                pass
+
+            # Flush por tamaño o por tiempo, lo que ocurra primero
+            if lote and (len(lote) >= self.batch_max or time.monotonic() >= limite):
+                self._flush(lote)
+                lote = []
+                limite = None
+
+            if self._detener.is_set():
+                while True:
+                    try:
+                        fila = self.cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    if fila is not None:
+                        lote.append(fila)
+                    if len(lote) >= self.batch_max:
+                        self._flush(lote)
+                        lote = []
+                if lote:
+                    self._flush(lote)
+                return
+
+    def _flush(self, lote):
+        eventos = [fila for tabla, fila in lote if tabla == "eventos"]
+        tipadas = [(tabla, fila) for tabla, fila in lote if tabla != "eventos"]
+        if eventos:
+            self._flush_eventos(eventos)
+        if tipadas:
+            self._flush_tipadas(tipadas)
+
+    def _flush_eventos(self, eventos):
+        valores = None
+        try:
+            t0 = time.perf_counter()
+            valores = [
+                (fecha, tipo, emisor_id, emisor_name, receptor_id, self._a_json(extra))
+                for fecha, tipo, emisor_id, emisor_name, receptor_id, extra in eventos
+            ]
+            metricas.observar("serializacion_json_segundos", time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            with pool_db.conexion() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(QUERY_INSERT_EVENTO, valores)
+                conn.commit()
+                cursor.close()
+            metricas.observar("db_insert_segundos", time.perf_counter() - t0, "eventos")
+            metricas.observar("db_lote_filas", len(valores), "eventos")
+        except Exception as e:
+            metricas.inc("db_errores_total", "eventos")
+            logging.getLogger("MeshBot").error(f"{Fore.RED}[DB ERROR] lote de {len(eventos)} eventos: {e}{Style.RESET_ALL}")
+            # MySQL no disponible: el lote queda en disco hasta que vuelva
+            if valores:
+                spool_local.guardar(valores)
+
+    @staticmethod
+    def _a_json(extra):
+        # Un payload que no se puede serializar no debe llevarse puesto al resto del lote
+        try:
+            return payload_a_json(extra)
+        except Exception:
+            return json.dumps(str(extra), ensure_ascii=False)
+
+    def _flush_tipadas(self, filas):
+        # Transacción aparte: si faltan las tablas tipadas no se pierde eventos.
+        # Estas filas no van al spool (los rollups se suman: reenviarlos duplicaría);
+        # lo perdido se cuenta en filas_tipadas_perdidas_total y se reconstruye
+        # después con backfill_tablas.py.
+        try:
+            t0 = time.perf_counter()
+            with pool_db.conexion() as conn:
+                cursor = conn.cursor()
+                insertar_filas_tipadas(cursor, filas)
+                conn.commit()
+                cursor.close()
+            metricas.observar("db_insert_segundos", time.perf_counter() - t0, "tipadas")
+            metricas.observar("db_lote_filas", len(filas), "tipadas")
+        except Exception as e:
+            metricas.inc("db_errores_total", "tipadas")
+            for tabla, n in Counter(tabla for tabla, _ in filas).items():
+                metricas.inc("filas_tipadas_perdidas_total", tabla, valor=n)
+            logging.getLogger("MeshBot").error(f"{Fore.RED}[DB ERROR] {len(filas)} filas tipadas perdidas: {e}{Style.RESET_ALL}")
+
+
+# ------------------------
+# SPOOL LOCAL (MySQL caído)
+# ------------------------
+
+# Si MySQL no acepta un lote, las filas van a un SQLite local en vez de perderse.
+# Un hilo aparte las reenvía en bloque cuando la base vuelve, con su fecha original.
+SPOOL_PATH = "midoluz_spool.db"
+SPOOL_REENVIO_LOTE = 500        # filas por INSERT al vaciar el spool
+SPOOL_REENVIO_INTERVALO = 15.0  # segundos entre intentos de reenvío
+
+# Errores de MySQL que dependen de la fila y no de la conexión: reintentar no sirve
+ERRORES_DE_FILA = (mysql.connector.errors.DataError, mysql.connector.errors.IntegrityError)
+
+
+class SpoolLocal:
+    """Cola durable en SQLite para los eventos que no se pudieron guardar en MySQL."""
+
+    def __init__(self, ruta=SPOOL_PATH, lote=SPOOL_REENVIO_LOTE, intervalo=SPOOL_REENVIO_INTERVALO):
+        self.ruta = ruta
+        self.lote = lote
+        self.intervalo = intervalo
+        self.pendientes = 0
+        self.reenviados = 0
+        self.en_cuarentena = 0
+        self.ultimo_reenvio = None
+        self.ultimo_error = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def _abrir(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.ruta, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS spool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fecha_hora TEXT,
+                    tipo_paquete TEXT,
+                    emisor_id TEXT,
+                    emisor_name TEXT,
+                    receptor_id TEXT,
+                    data_json TEXT
+                )
+            """)
+            # Filas que MySQL rechaza por su contenido: se apartan para no trabar el resto
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cuarentena (
+                    id INTEGER PRIMARY KEY,
+                    fecha_hora TEXT,
+                    tipo_paquete TEXT,
+                    emisor_id TEXT,
+                    emisor_name TEXT,
+                    receptor_id TEXT,
+                    data_json TEXT,
+                    error TEXT
+                )
+            """)
+            self._conn.commit()
+            self.pendientes = self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+            self.en_cuarentena = self._conn.execute("SELECT COUNT(*) FROM cuarentena").fetchone()[0]
+        return self._conn
+
+    def guardar(self, valores):
+        """Recibe las mismas tuplas que QUERY_INSERT_EVENTO y las deja en disco."""
+        filas = [
+            (fecha.isoformat(sep=" ", timespec="seconds") if isinstance(fecha, datetime) else fecha, *resto)
+            for fecha, *resto in valores
+        ]
+        try:
+            with self._lock:
+                conn = self._abrir()
+                conn.executemany(
+                    "INSERT INTO spool (fecha_hora, tipo_paquete, emisor_id, emisor_name, receptor_id, data_json) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    filas
+                )
+                conn.commit()
+                self.pendientes += len(filas)
+        except Exception as e:
+            logging.getLogger("MeshBot").error(f"{Fore.RED}[SPOOL ERROR] {len(filas)} eventos perdidos: {e}{Style.RESET_ALL}")
+
+    def start(self):
+        with self._lock:
+            self._abrir()
+        if self.pendientes:
+            logging.getLogger("MeshBot").warning(f"{Fore.YELLOW}[SPOOL] {self.pendientes} eventos pendientes de reenvío{Style.RESET_ALL}")
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._loop, name="SpoolLocal", daemon=True)
+        self._hilo.start()
+
+    def stop(self, timeout=10):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def _loop(self):
+        while not self._detener.wait(self.intervalo):
+            if self.pendientes:
+                self.reenviar()
+
+    def reenviar(self):
+        """Vacía el spool hacia MySQL por bloques.
+
+        Un error de conexión corta y se reintenta en la próxima vuelta. Si MySQL
+        rechaza el bloque por el contenido de alguna fila, se reenvía fila por fila
+        y las rechazadas pasan a la tabla cuarentena del spool.
+        """
+        while not self._detener.is_set():
+            with self._lock:
+                filas = self._abrir().execute(
+                    "SELECT id, fecha_hora, tipo_paquete, emisor_id, emisor_name, receptor_id, data_json "
+                    "FROM spool ORDER BY id LIMIT ?",
+                    (self.lote,)
+                ).fetchall()
+            if not filas:
+                return
+
+            # El INSERT a MySQL va fuera del lock para no frenar a guardar()
+            rechazadas = []
+            try:
+                with pool_db.conexion() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        cursor.executemany(QUERY_INSERT_EVENTO, [f[1:] for f in filas])
+                    except ERRORES_DE_FILA:
+                        conn.rollback()
+                        rechazadas = self._insertar_de_a_una(cursor, filas)
+                    conn.commit()
+                    cursor.close()
+            except Exception as e:
+                self.ultimo_error = str(e)
+                return
+
+            with self._lock:
+                conn = self._abrir()
+                if rechazadas:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO cuarentena (id, fecha_hora, tipo_paquete, emisor_id, emisor_name, "
+                        "receptor_id, data_json, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rechazadas
+                    )
+                    self.en_cuarentena += len(rechazadas)
+                conn.execute("DELETE FROM spool WHERE id <= ?", (filas[-1][0],))
+                conn.commit()
+                self.pendientes = max(0, self.pendientes - len(filas))
+            if rechazadas:
+                logging.getLogger("MeshBot").error(
+                    f"{Fore.RED}[SPOOL] {len(rechazadas)} eventos rechazados por MySQL pasan a cuarentena: "
+                    f"{rechazadas[0][-1]}{Style.RESET_ALL}"
+                )
+            self.reenviados += len(filas) - len(rechazadas)
+            self.ultimo_reenvio = datetime.now()
+            self.ultimo_error = None
+            logging.getLogger("MeshBot").info(
+                f"{Fore.GREEN}[SPOOL] Reenviados {len(filas)} eventos "
+                f"(total {self.reenviados}, pendientes {self.pendientes}){Style.RESET_ALL}"
+            )
+
+    @staticmethod
+    def _insertar_de_a_una(cursor, filas):
+        """Inserta cada fila por separado; devuelve las rechazadas (con el error) para la cuarentena."""
+        rechazadas = []
+        for fila in filas:
+            try:
+                cursor.execute(QUERY_INSERT_EVENTO, fila[1:])
+            except ERRORES_DE_FILA as e:
+                rechazadas.append((*fila, str(e)))
+        return rechazadas
+
+    def estado(self):
+        return {
+            "pendientes": self.pendientes,
+            "reenviados": self.reenviados,
+            "en_cuarentena": self.en_cuarentena,
+            "ultimo_reenvio": self.ultimo_reenvio.isoformat(timespec="seconds") if self.ultimo_reenvio else None,
+            "ultimo_error": self.ultimo_error,
+        }
+
+
+spool_local = SpoolLocal()
+
+
+escritor_db = EscritorDB()
+
+
+def registrar_en_db(tipo, emisor_id, emisor_name, receptor_id, extra_data):
+    # La hora se toma al recibir el paquete, no al insertar el lote
+    fecha = datetime.now()
+    if not escritor_db.encolar(("eventos", (fecha, tipo, emisor_id, emisor_name, receptor_id, extra_data))):
+        logging.getLogger("MeshBot").error("[DB ERROR] Cola llena, evento descartado (%d)", escritor_db.descartados)
+        return
+    if TABLAS_TIPADAS or ROLLUPS:
+        for tabla, fila in filas_tipadas(tipo, emisor_id, fecha, extra_data):
+            if TABLAS_TIPADAS and not escritor_db.encolar((tabla, fila)):
+                metricas.inc("filas_tipadas_perdidas_total", tabla)
+                logging.getLogger("MeshBot").error("[DB ERROR] Cola llena, fila de %s descartada", tabla)
+            if ROLLUPS:
+                agregador_rollups.agregar(tabla, fila)
+
+
+# ------------------------
+# CLIENTE HTTP
+# ------------------------
+
+URL_CORTES = "http://192.168.0.27:8000/cortes_detalle_agrupados"
+URL_DEMANDA = "http://192.168.0.8:5005/api/last_sadi"
+
+HTTP_TIMEOUT_CONEXION = 2.0   # segundos para abrir el TCP
+HTTP_TIMEOUT_LECTURA = 3.0    # segundos esperando la respuesta
+HTTP_POOL_POR_HOST = 4        # conexiones keep-alive por host
+
+
+class ClienteHTTP:
+    """Sesión requests compartida: reutiliza conexiones keep-alive y mide latencia por endpoint."""
+
+    def __init__(self, timeout_conexion=HTTP_TIMEOUT_CONEXION, timeout_lectura=HTTP_TIMEOUT_LECTURA,
+                 pool_por_host=HTTP_POOL_POR_HOST):
+        self.timeout = (timeout_conexion, timeout_lectura)
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=pool_por_host, max_retries=0)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.mount("https://", adaptador)
+        self.latencias = {}      # url -> contadores
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        t0 = time.perf_counter()
+        error = False
+        timeout = self.timeout
+        # Desde un comando, la lectura no espera más de lo que le queda de plazo
+        restante = ejecutor_comandos.restante()
+        if restante is not None:
+            timeout = (timeout[0], max(0.1, min(timeout[1], restante)))
+        try:
+            return self.sesion.get(url, timeout=timeout, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._medir(url, time.perf_counter() - t0, error)
+
+    def _medir(self, url, segundos, error):
+        metricas.observar("upstream_segundos", segundos, url)
+        if error:
+            metricas.inc("upstream_errores_total", url)
+        with self._lock:
+            m = self.latencias.setdefault(url, {"llamadas": 0, "errores": 0, "total_s": 0.0, "max_s": 0.0, "ultima_s": 0.0})
+            m["llamadas"] += 1
+            m["errores"] += error
+            m["total_s"] += segundos
+            m["ultima_s"] = segundos
+            m["max_s"] = max(m["max_s"], segundos)
+
+    def calentar(self, urls):
+        """Abre de antemano la conexión a cada host para que el primer comando no pague el handshake."""
+        def _calentar():
+            for url in urls:
+                try:
+                    self.sesion.head(url, timeout=self.timeout)
+                except Exception:
+                    pass
+        threading.Thread(target=_calentar, name="HTTPCalentar", daemon=True).start()
+
+    def estado(self):
+        with self._lock:
+            return {
+                url: {
+                    "llamadas": m["llamadas"],
+                    "errores": m["errores"],
+                    "promedio_ms": round(1000 * m["total_s"] / m["llamadas"], 1),
+                    "ultima_ms": round(1000 * m["ultima_s"], 1),
+                    "max_ms": round(1000 * m["max_s"], 1),
+                }
+                for url, m in self.latencias.items()
+            }
+
+
+cliente_http = ClienteHTTP()
 
 
 # ------------------------
@@ -275,13 +1952,14 @@ def registrar_en_db(tipo, emisor_id, emisor_name, receptor_id, extra_data):
 
 def obtener_cortes_por_empresa():
     try:
-        import requests
-        from collections import defaultdict
-        r = requests.get("http://192.168.0.27:8000/cortes_detalle_agrupados", timeout=3)
+        r = cliente_http.get(URL_CORTES)
         data = r.json().get("resultados", [])
         if not data: return ["Sin cortes reportados"]
 
-        empresas = defaultdict(list)
+        # Un ítem por localidad, agrupado por empresa; el empaquetador arma los
+        # mensajes sin perder ninguna localidad
+        items = []
+        mapa_nombres = {"Edenor": "EN", "Edesur": "ES"}
         for c in data:
             est_raw = c.get("normalizacion_estimada", "")
             try:
@@ -290,44 +1968,113 @@ def obtener_cortes_por_empresa():
                 hora = "??"
             loc = c.get("localidad", "Unk")
             afectados = c.get("total_afectados", 0)
-            empresas[c["empresa"]].append(f"{loc} {afectados}@{hora}")
+            prefijo = mapa_nombres.get(c["empresa"], c["empresa"])
+            items.append((prefijo, f"{loc} {afectados}@{hora}"))
 
-        mensajes_finales = []
-        mapa_nombres = {"Edenor": "EN", "Edesur": "ES"}
-        for empresa, items in empresas.items():
-            prefijo = mapa_nombres.get(empresa, empresa)
-            mensajes_finales.append(f"{prefijo} | {', '.join(items)}"[:200])
-        return mensajes_finales
+        return empaquetar_respuesta(items)
     except Exception as e:
         return [f"Error cortes: {e}"]
 
 def obtener_demanda_compacta():
     try:
-        import requests
-        r = requests.get("http://192.168.0.8:5005/api/last_sadi", timeout=3)
+        r = cliente_http.get(URL_DEMANDA)
         d = r.json()
         return f"Demanda {d.get('time_muestra','??')} | Hoy:{d.get('DemHoy','?')}MW | Est:{d.get('Predespacho','?')}MW"
     except Exception:
         return "Error leyendo demanda"
         
+# ------------------------
+# ESTADO DE SUBTE (último por línea)
+# ------------------------
+
+# /subte no consulta el histórico: un hilo lee solo las filas nuevas de
+# estado_subte (por fecha_registro) y mantiene en memoria el último estado de
+# cada línea. La consulta con GROUP BY se usa una sola vez, para la carga inicial.
+SUBTE_POLL_INTERVALO = 30.0   # segundos entre lecturas de filas nuevas
+
+QUERY_SUBTE_ULTIMO = """
+    SELECT s1.linea, s1.estado, s1.fecha_registro
+    FROM estado_subte s1
+    INNER JOIN (
+        SELECT linea, MAX(fecha_registro) as max_fecha
+        FROM estado_subte
+        GROUP BY linea
+    ) s2 ON s1.linea = s2.linea AND s1.fecha_registro = s2.max_fecha
+"""
+
+# >= y no >: filas con la misma fecha que la última vista pueden haber llegado después
+QUERY_SUBTE_NUEVOS = """
+    SELECT linea, estado, fecha_registro
+    FROM estado_subte
+    WHERE fecha_registro >= %s
+    ORDER BY fecha_registro
+"""
+
+
+class EstadoSubte:
+    """Proyección en memoria linea -> (estado, fecha_registro), actualizada de forma incremental."""
+
+    def __init__(self, intervalo=SUBTE_POLL_INTERVALO):
+        self.intervalo = intervalo
+        self.ultima_lectura = None
+        self._lineas = {}
+        self._marca = None          # fecha_registro más nueva vista
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def actualizar(self):
+        if self._marca is None:
+            query, params = QUERY_SUBTE_ULTIMO, ()
+        else:
+            query, params = QUERY_SUBTE_NUEVOS, (self._marca,)
+        with pool_db.conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+
+        with self._lock:
+            for linea, estado, fecha in rows:
+                actual = self._lineas.get(linea)
+                if actual is None or fecha >= actual[1]:
+                    self._lineas[linea] = (estado, fecha)
+                if self._marca is None or fecha > self._marca:
+                    self._marca = fecha
+        self.ultima_lectura = datetime.now()
+
+    def lineas(self):
+        """[(linea, estado, fecha_registro)] ordenado por línea."""
+        with self._lock:
+            return [(linea, estado, fecha) for linea, (estado, fecha) in sorted(self._lineas.items())]
+
+    def start(self):
+        self._hilo = threading.Thread(target=self._loop, name="EstadoSubte", daemon=True)
+        self._hilo.start()
+
+    def stop(self):
+        self._detener.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self.actualizar()
+            except Exception as e:
+                logging.getLogger("MeshBot").error(f"Error actualizando estado de subte: {e}")
+            if self._detener.wait(self.intervalo):
+                return
+
+
+estado_subte = EstadoSubte()
+
+
 def obtener_estado_subte_compacto():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        query = """
-            SELECT s1.linea, s1.estado, s1.fecha_registro
-            FROM estado_subte s1
-            INNER JOIN (
-                SELECT linea, MAX(fecha_registro) as max_fecha
-                FROM estado_subte
-                GROUP BY linea
-            ) s2 ON s1.linea = s2.linea AND s1.fecha_registro = s2.max_fecha
-            ORDER BY s1.linea ASC
-        """
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        if not rows: return "❌ Sin datos de subte"
+        if estado_subte.ultima_lectura is None:
+            # Todavía no hubo lectura de fondo (arranque o MySQL caído): la hacemos acá
+            estado_subte.actualizar()
+        rows = estado_subte.lineas()
+        if not rows: return ["❌ Sin datos de subte"]
 
         resumen = []
         fecha_data = rows[0][2].strftime("%H:%M")
@@ -352,19 +2099,1196 @@ def obtener_estado_subte_compacto():
                 # Si es un texto raro, tomamos las primeras 10 letras
                 msg = estado[:10].strip()
 
-            resumen.append(f"{L}:{msg}")
+            resumen.append((f"🚇{fecha_data}", f"{L}:{msg}"))
 
-        cursor.close()
-        conn.close()
-        
-        # Unimos con separador compacto
-        final_msg = f"🚇{fecha_data} | " + " ".join(resumen)
-        
-        # Si aún así supera los 200 (raro), recortamos
-        return final_msg[:200]
+        # Si no entra en un paquete se parte, sin recortar líneas
+        return empaquetar_respuesta(resumen)
 
     except Exception as e:
-        return f"Error Subte: {e}"  
+        return [f"Error Subte: {e}"]
+
+# ------------------------
+# CACHE DE RESPUESTAS
+# ------------------------
+
+# Cortes, demanda y subte cambian cada varios minutos: no tiene sentido ir al
+# upstream por cada nodo que pregunta. Dentro del TTL se responde de memoria;
+# vencido, se responde lo viejo y se refresca en segundo plano.
+CACHE_TTL = {"cortes": 120, "demanda": 60}   # segundos
+CACHE_MAX_VIEJO = 900      # pasado TTL + esto ya no se sirve el valor viejo
+CACHE_PRECARGA = False     # True: un hilo refresca antes de que venza el TTL
+CACHE_PRECARGA_INTERVALO = 10.0
+CACHE_TTL_ERROR = 30       # tras un error del upstream no se lo vuelve a consultar antes de esto
+
+
+def _respuesta_con_error(valor):
+    # Las funciones de API no lanzan excepciones: devuelven un texto "Error ..."
+    primero = valor[0] if isinstance(valor, list) and valor else valor
+    return isinstance(primero, str) and primero.startswith("Error")
+
+
+class CacheRespuestas:
+    """Cache con TTL por comando, stale-while-revalidate y precarga opcional."""
+
+    def __init__(self, max_viejo=CACHE_MAX_VIEJO):
+        self.max_viejo = max_viejo
+        self.aciertos = 0
+        self.viejos = 0
+        self.fallos = 0
+        self._fuentes = {}       # clave -> (funcion, ttl)
+        self._entradas = {}      # clave -> (valor, monotonic al guardar)
+        self._errores = {}       # clave -> (respuesta con error, monotonic del fallo)
+        self._locks = {}         # un refresco en vuelo por clave
+        self._detener = threading.Event()
+
+    def registrar(self, clave, funcion, ttl):
+        self._fuentes[clave] = (funcion, ttl)
+        self._locks[clave] = threading.Lock()
+
+    def obtener(self, clave):
+        funcion, ttl = self._fuentes[clave]
+        entrada = self._entradas.get(clave)
+        if entrada:
+            edad = time.monotonic() - entrada[1]
+            if edad < ttl:
+                self.aciertos += 1
+                return entrada[0]
+            if edad < ttl + self.max_viejo:
+                self.viejos += 1
+                self._refrescar_en_fondo(clave)
+                return entrada[0]
+
+        error = self._error_reciente(clave)
+        if error:
+            return error
+        self.fallos += 1
+        return self._refrescar(clave)
+
+    def _error_reciente(self, clave):
+        # Cache negativo: mientras el upstream está caído, a lo sumo un intento cada CACHE_TTL_ERROR
+        error = self._errores.get(clave)
+        if error and time.monotonic() - error[1] < CACHE_TTL_ERROR:
+            return error[0]
+        return None
+
+    def _refrescar(self, clave):
+        """Consulta el upstream; si otro hilo ya lo está haciendo, espera y usa ese resultado."""
+        lock = self._locks[clave]
+        if not lock.acquire(blocking=False):
+            with lock:
+                pass
+            entrada = self._entradas.get(clave)
+            if entrada:
+                return entrada[0]
+            error = self._error_reciente(clave)
+            if error:
+                return error
+            lock.acquire()
+        try:
+            valor = self._fuentes[clave][0]()
+            if _respuesta_con_error(valor):
+                self._errores[clave] = (valor, time.monotonic())
+                entrada = self._entradas.get(clave)
+                # Si hay un valor viejo todavía servible, se sigue respondiendo con él
+                if entrada and time.monotonic() - entrada[1] < self._fuentes[clave][1] + self.max_viejo:
+                    return entrada[0]
+            else:
+                self._entradas[clave] = (valor, time.monotonic())
+                self._errores.pop(clave, None)
+            return valor
+        finally:
+            lock.release()
+
+    def _refrescar_en_fondo(self, clave):
+        if self._locks[clave].locked() or self._error_reciente(clave):
+            return
+        threading.Thread(target=self._refrescar, args=(clave,), name=f"Cache-{clave}", daemon=True).start()
+
+    def start_precarga(self, intervalo=CACHE_PRECARGA_INTERVALO):
+        threading.Thread(target=self._loop_precarga, args=(intervalo,), name="CachePrecarga", daemon=True).start()
+
+    def stop(self):
+        self._detener.set()
+
+    def _loop_precarga(self, intervalo):
+        while not self._detener.wait(intervalo):
+            for clave, (_, ttl) in self._fuentes.items():
+                entrada = self._entradas.get(clave)
+                # Refrescamos un poco antes del vencimiento para no servir nunca viejo
+                if self._error_reciente(clave):
+                    continue
+                if not entrada or time.monotonic() - entrada[1] > ttl * 0.8:
+                    try:
+                        self._refrescar(clave)
+                    except Exception as e:
+                        logging.getLogger("MeshBot").error(f"Error precargando {clave}: {e}")
+
+    def estado(self):
+        ahora = time.monotonic()
+        return {
+            "aciertos": self.aciertos,
+            "viejos": self.viejos,
+            "fallos": self.fallos,
+            "edad": {clave: round(ahora - t, 1) for clave, (_, t) in self._entradas.items()},
+            "ultimo_error": {clave: round(ahora - t, 1) for clave, (_, t) in self._errores.items()},
+        }
+
+
+cache_respuestas = CacheRespuestas()
+cache_respuestas.registrar("cortes", obtener_cortes_por_empresa, CACHE_TTL["cortes"])
+cache_respuestas.registrar("demanda", obtener_demanda_compacta, CACHE_TTL["demanda"])
+
+
+# ------------------------
+# PLANIFICADOR DE TRANSMISIÓN
+# ------------------------
+
+# Todo lo que sale por la radio pasa por acá: respuestas a comandos, endpoints
+# REST y telemetría. Se limita el tiempo al aire con un token bucket y se
+# atiende primero lo interactivo.
+TX_DUTY_CYCLE = 0.30         # fracción del tiempo que el bot puede ocupar el aire
+TX_RAFAGA_S = 6.0            # segundos de airtime acumulables (tamaño del bucket)
+TX_BYTES_POR_SEG = 134       # ~1.07 kbps, preset LongFast
+TX_OVERHEAD_BYTES = 32       # header LoRa + header Meshtastic
+TX_COLA_MAX = 500
+TX_HISTORIAL_MAX = 1000      # envíos recordados para /SendStatus
+MESH_MAX_BYTES = mesh_pb2.Constants.DATA_PAYLOAD_LEN   # bytes de payload por paquete
+
+PRIORIDAD_INTERACTIVA = 0    # respuestas a comandos
+PRIORIDAD_NORMAL = 1         # mensajes directos por REST
+PRIORIDAD_BULK = 2           # broadcasts y telemetría
+NOMBRES_PRIORIDAD = {PRIORIDAD_INTERACTIVA: "interactiva", PRIORIDAD_NORMAL: "normal", PRIORIDAD_BULK: "bulk"}
+
+
+def partir_texto(texto, max_bytes=MESH_MAX_BYTES):
+    """Corta un texto en partes de hasta max_bytes en UTF-8, en bordes de palabra.
+    Los espacios y saltos de línea entre palabras se conservan salvo en el borde
+    de cada corte. Una palabra que sola no entra se corta por caracteres (nunca a
+    mitad de uno)."""
+    partes = []
+    actual, actual_bytes = "", 0
+    separador = ""      # espacio pendiente entre actual y la próxima palabra
+    for token in re.split(r"(\s+)", texto):
+        if not token:
+            continue
+        if token.isspace():
+            separador = token if actual else ""
+            continue
+        n = len(token.encode("utf-8"))
+        extra = n + len(separador.encode("utf-8"))
+        if actual and actual_bytes + extra <= max_bytes:
+            actual += separador + token
+            actual_bytes += extra
+        else:
+            if actual:
+                partes.append(actual)
+            actual, actual_bytes = token, n
+            if n > max_bytes:
+                trozo, trozo_bytes = [], 0
+                for caracter in token:
+                    nc = len(caracter.encode("utf-8"))
+                    if trozo_bytes + nc > max_bytes:
+                        partes.append("".join(trozo))
+                        trozo, trozo_bytes = [], 0
+                    trozo.append(caracter)
+                    trozo_bytes += nc
+                actual, actual_bytes = "".join(trozo), trozo_bytes
+        separador = ""
+    if actual:
+        partes.append(actual)
+    return partes
+
+
+# Empaquetado de respuestas de varias partes: los ítems lógicos (una localidad,
+# una línea de subte) se acomodan en la menor cantidad de paquetes posible, sin
+# recortar ninguno. Cada ítem tiene un grupo ("EN", "ES", ...) cuyo encabezado
+# solo se paga en los paquetes donde aparece.
+SEP_ITEM = ", "
+SEP_GRUPO = "; "
+
+
+def _bytes(texto):
+    return len(texto.encode("utf-8"))
+
+
+def _encabezado(grupo):
+    return f"{grupo} | " if grupo else ""
+
+
+def _acomodar(items, capacidad):
+    """First-fit decreasing: los ítems más largos primero, cada uno en el primer
+    paquete donde entra. Devuelve [(bytes, {grupo: [(orden, texto)]})]."""
+    sep_item, sep_grupo = _bytes(SEP_ITEM), _bytes(SEP_GRUPO)
+    paquetes = []
+    for orden, grupo, texto, n in sorted(items, key=lambda i: -i[3]):
+        for i, (usados, grupos) in enumerate(paquetes):
+            if grupo in grupos:
+                costo = sep_item + n
+            else:
+                costo = sep_grupo + _bytes(_encabezado(grupo)) + n
+            if usados + costo <= capacidad:
+                grupos.setdefault(grupo, []).append((orden, texto))
+                paquetes[i] = (usados + costo, grupos)
+                break
+        else:
+            paquetes.append((_bytes(_encabezado(grupo)) + n, {grupo: [(orden, texto)]}))
+    return paquetes
+
+
+def _renderizar(grupos):
+    partes = []
+    # Grupos e ítems en el orden original, aunque se hayan acomodado por tamaño
+    for grupo, items in sorted(grupos.items(), key=lambda g: min(o for o, _ in g[1])):
+        partes.append(_encabezado(grupo) + SEP_ITEM.join(t for _, t in sorted(items)))
+    return SEP_GRUPO.join(partes)
+
+
+def empaquetar_respuesta(items, max_bytes=MESH_MAX_BYTES):
+    """Arma los mensajes de una respuesta de varias partes.
+
+    items es una lista de (grupo, texto); grupo puede ser None. Si hace falta
+    más de un paquete, cada uno termina con "(i/n)". Un ítem que no entra solo
+    en un paquete se parte con partir_texto en vez de recortarse."""
+    normalizados = []
+    for grupo, texto in items:
+        lugar = max_bytes - _bytes(_encabezado(grupo)) - _bytes(" (99/99)")
+        trozos = partir_texto(texto, lugar) if _bytes(texto) > lugar else [texto]
+        for trozo in trozos:
+            normalizados.append((len(normalizados), grupo, trozo, _bytes(trozo)))
+    if not normalizados:
+        return []
+
+    paquetes = _acomodar(normalizados, max_bytes)
+    if len(paquetes) > 1:
+        # Reservamos lugar para el marcador; si al achicar hacen falta más
+        # paquetes y cambia la cantidad de dígitos, volvemos a acomodar
+        reserva = 0
+        while True:
+            total = len(paquetes)
+            nueva = _bytes(f" ({total}/{total})")
+            if nueva == reserva:
+                break
+            reserva = nueva
+            paquetes = _acomodar(normalizados, max_bytes - reserva)
+
+    paquetes.sort(key=lambda p: min(o for items in p[1].values() for o, _ in items))
+    mensajes = [_renderizar(grupos) for _, grupos in paquetes]
+    if len(mensajes) > 1:
+        mensajes = [f"{m} ({i}/{len(mensajes)})" for i, m in enumerate(mensajes, 1)]
+    return mensajes
+
+
+def _num_nodo(destino):
+    """destinationId de meshtastic (int, "!hex" o "^all") -> número de nodo, o None si es broadcast."""
+    if isinstance(destino, int):
+        return None if destino == 0xffffffff else destino
+    if isinstance(destino, str) and destino.startswith("!"):
+        try:
+            return int(destino[1:], 16)
+        except ValueError:
+            return None
+    return None
+
+
+class EnvioTX:
+    def __init__(self, metodo, kwargs, prioridad, airtime, esperar_ack=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.metodo = metodo          # "sendText" o "sendData" de la interfaz meshtastic
+        self.kwargs = kwargs
+        self.prioridad = prioridad
+        self.airtime = airtime
+        self.esperar_ack = esperar_ack
+        self.destino = _num_nodo(kwargs.get("destinationId"))
+        # en_cola -> enviado -> retransmitido (ACK implícito) -> confirmado (ACK del destino), o error
+        self.estado = "en_cola"
+        self.error = None
+        self.packet_id = None
+        self.creado = datetime.now()
+        self.actualizado = self.creado
+
+    def terminar(self, estado, error=None):
+        self.estado = estado
+        self.error = error
+        self.actualizado = datetime.now()
+
+    def a_dict(self):
+        return {
+            "id": self.id,
+            "estado": self.estado,
+            "error": self.error,
+            "prioridad": NOMBRES_PRIORIDAD[self.prioridad],
+            "packet_id": self.packet_id,
+            "creado": self.creado.isoformat(timespec="seconds"),
+            "actualizado": self.actualizado.isoformat(timespec="seconds"),
+        }
+
+
+class PlanificadorTX:
+    """Cola con prioridades que transmite apenas el presupuesto de airtime lo permite."""
+
+    def __init__(self, duty_cycle=TX_DUTY_CYCLE, rafaga=TX_RAFAGA_S, cola_max=TX_COLA_MAX):
+        self.tasa = duty_cycle       # segundos de airtime ganados por segundo
+        self.rafaga = rafaga
+        self.cola_max = cola_max
+        self.tokens = rafaga
+        self.enviados = 0
+        self.errores = 0
+        self.rechazados = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._historial = OrderedDict()     # id -> EnvioTX, para /SendStatus
+        self._esperando_ack = {}            # packet_id -> EnvioTX
+        self._ultima_recarga = time.monotonic()
+        self._cond = threading.Condition()
+        self._detener = False
+        self._hilo = None
+
+    @staticmethod
+    def airtime(n_bytes):
+        return (n_bytes + TX_OVERHEAD_BYTES) / TX_BYTES_POR_SEG
+
+    @staticmethod
+    def pedido_texto(text, prioridad=PRIORIDAD_INTERACTIVA, esperar_ack=False, **kwargs):
+        """Arma el pedido para encolar_lote; texto() es el atajo para uno solo."""
+        if esperar_ack:
+            kwargs["wantAck"] = True
+        return ("sendText", dict(text=text, **kwargs), len(text.encode("utf-8")), prioridad, esperar_ack)
+
+    def texto(self, text, prioridad=PRIORIDAD_INTERACTIVA, esperar_ack=False, **kwargs):
+        return self.encolar(*self.pedido_texto(text, prioridad, esperar_ack, **kwargs))
+
+    def datos(self, data, prioridad=PRIORIDAD_BULK, **kwargs):
+        return self.encolar("sendData", dict(data=data, **kwargs), len(data), prioridad)
+
+    def encolar(self, metodo, kwargs, n_bytes, prioridad, esperar_ack=False):
+        return self.encolar_lote([(metodo, kwargs, n_bytes, prioridad, esperar_ack)])[0]
+
+    def encolar_lote(self, pedidos):
+        """Encola varios envíos con un solo lock; si no entran todos en la cola no se encola ninguno."""
+        # Un paquete más grande que el bucket igual tiene que poder salir
+        envios = [
+            EnvioTX(metodo, kwargs, prioridad, min(self.airtime(n_bytes), self.rafaga), esperar_ack)
+            for metodo, kwargs, n_bytes, prioridad, esperar_ack in pedidos
+        ]
+        with self._cond:
+            # Los rechazados no van al historial: no deben desplazar a los envíos reales
+            if len(self._heap) + len(envios) > self.cola_max:
+                self.rechazados += len(envios)
+                for envio in envios:
+                    envio.terminar("error", "Cola de transmisión llena")
+                return envios
+            for envio in envios:
+                self._historial[envio.id] = envio
+            while len(self._historial) > TX_HISTORIAL_MAX:
+                _, viejo = self._historial.popitem(last=False)
+                self._esperando_ack.pop(viejo.packet_id, None)
+            for envio in envios:
+                heapq.heappush(self._heap, (envio.prioridad, next(self._seq), envio))
+            self._cond.notify()
+        return envios
+
+    def start(self):
+        self._hilo = threading.Thread(target=self._loop, name="PlanificadorTX", daemon=True)
+        self._hilo.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._detener = True
+            self._cond.notify()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.rafaga, self.tokens + (ahora - self._ultima_recarga) * self.tasa)
+        self._ultima_recarga = ahora
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._detener:
+                    self._cond.wait()
+                if self._detener:
+                    for _, _, envio in self._heap:
+                        envio.terminar("error", "Bot detenido")
+                    self._heap.clear()
+                    return
+                envio = self._heap[0][2]
+                self._recargar()
+                falta = envio.airtime - self.tokens
+                if falta > 0:
+                    # Si mientras tanto llega algo más prioritario, nos despierta y lo atendemos primero
+                    self._cond.wait(falta / self.tasa)
+                    continue
+                heapq.heappop(self._heap)
+                self.tokens -= envio.airtime
+            self._transmitir(envio)
+
+    def _transmitir(self, envio):
+        bot = mesh_bot_instance
+        try:
+            if not bot or not bot.interface:
+                raise RuntimeError("Bot no conectado")
+            paquete = getattr(bot.interface, envio.metodo)(**envio.kwargs)
+            envio.packet_id = getattr(paquete, "id", None)
+            self.enviados += 1
+            metricas.inc("envios_total", envio.metodo, "ok")
+            envio.terminar("enviado")
+            if envio.esperar_ack and envio.packet_id:
+                with self._cond:
+                    self._esperando_ack[envio.packet_id] = envio
+        except Exception as e:
+            self.errores += 1
+            metricas.inc("envios_total", envio.metodo, "error")
+            envio.terminar("error", str(e))
+            logging.getLogger("MeshBot").error(f"Error transmitiendo ({envio.metodo}): {e}")
+
+    def confirmar(self, packet_id, error_reason, de):
+        """Llamado desde on_receive con cada paquete ROUTING que responde a uno nuestro.
+
+        Solo el ACK que manda el propio destino confirma la entrega. El ACK implícito
+        (un vecino o nuestro nodo que retransmitió el paquete) solo dice que salió a
+        la mesh: queda "retransmitido" y se sigue esperando el del destino. Un
+        broadcast no tiene destino que confirme, así que ahí termina.
+        """
+        with self._cond:
+            envio = self._esperando_ack.get(packet_id)
+            if envio is None:
+                return
+            definitivo = error_reason not in (None, "NONE") or envio.destino is None or de == envio.destino
+            if definitivo:
+                del self._esperando_ack[packet_id]
+        if error_reason not in (None, "NONE"):
+            envio.terminar("error", f"Sin ACK: {error_reason}")
+        elif envio.destino is not None and de == envio.destino:
+            envio.terminar("confirmado")
+        elif envio.estado != "confirmado":
+            envio.terminar("retransmitido")
+
+    def buscar(self, envio_id):
+        with self._cond:
+            return self._historial.get(envio_id)
+
+    def estado(self):
+        with self._cond:
+            self._recargar()
+            por_prioridad = {nombre: 0 for nombre in NOMBRES_PRIORIDAD.values()}
+            for prioridad, _, _ in self._heap:
+                por_prioridad[NOMBRES_PRIORIDAD[prioridad]] += 1
+            return {
+                "en_cola": por_prioridad,
+                "airtime_disponible_s": round(self.tokens, 2),
+                "enviados": self.enviados,
+                "errores": self.errores,
+                "rechazados": self.rechazados,
+            }
+
+
+planificador_tx = PlanificadorTX()
+
+
+# ------------------------
+# EJECUTOR DE COMANDOS
+# ------------------------
+
+# Los comandos hacen requests bloqueantes y pausas entre respuestas: no pueden
+# correr en el hilo lector de meshtastic. on_receive solo los encola.
+COMANDOS_HILOS = 2         # comandos atendidos en paralelo
+COMANDOS_COLA_MAX = 50     # comandos esperando; si se llena se rechazan
+COMANDO_TIMEOUT = 60.0     # segundos desde que llega el comando hasta que se abandona
+
+
+class EjecutorComandos:
+    """Pool acotado de hilos para los comandos, con plazo máximo por comando.
+
+    El plazo es cooperativo: se descarta el comando que venció esperando en cola,
+    las consultas HTTP no esperan más allá del plazo (ClienteHTTP) y el comando
+    no responde si ya se pasó (vencido()).
+    """
+
+    def __init__(self, hilos=COMANDOS_HILOS, cola_max=COMANDOS_COLA_MAX, timeout=COMANDO_TIMEOUT):
+        self.hilos = hilos
+        self.timeout = timeout
+        self.cola = queue.Queue(maxsize=cola_max)
+        self.en_curso = 0
+        self.ejecutados = 0
+        self.rechazados = 0
+        self.vencidos = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilos = []
+
+    def start(self):
+        for n in range(self.hilos):
+            hilo = threading.Thread(target=self._loop, name=f"Comandos-{n}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def stop(self):
+        # Sin put bloqueante: con la cola llena el apagado no puede quedar esperando
+        self._detener.set()
+        for _ in self._hilos:
+            try:
+                self.cola.put_nowait(None)
+            except queue.Full:
+                break
+
+    def enviar(self, funcion, *args):
+        try:
+            self.cola.put_nowait((time.monotonic() + self.timeout, funcion, args))
+            return True
+        except queue.Full:
+            self.rechazados += 1
+            return False
+
+    def restante(self):
+        """Segundos que le quedan al comando de este hilo, o None fuera de un comando."""
+        limite = getattr(self._local, "limite", None)
+        return None if limite is None else limite - time.monotonic()
+
+    def vencido(self):
+        """Para que un comando deje de responder (o corte las partes que faltan) si se pasó de plazo."""
+        restante = self.restante()
+        return restante is not None and restante <= 0
+
+    def _loop(self):
+        log = logging.getLogger("MeshBot")
+        while not self._detener.is_set():
+            try:
+                trabajo = self.cola.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if trabajo is None or self._detener.is_set():
+                return
+            limite, funcion, args = trabajo
+            if time.monotonic() > limite:
+                self.vencidos += 1
+                metricas.inc("comandos_descartados_total", "vencido")
+                log.warning(f"Comando descartado: esperó más de {self.timeout:.0f}s en cola")
+                continue
+
+            self._local.limite = limite
+            with self._lock:
+                self.en_curso += 1
+            try:
+                funcion(*args)
+            except Exception as e:
+                log.error(f"Error ejecutando comando: {e}")
+            finally:
+                with self._lock:
+                    self.en_curso -= 1
+                self.ejecutados += 1
+                self._local.limite = None
+
+    def estado(self):
+        return {
+            "en_cola": self.cola.qsize(),
+            "en_curso": self.en_curso,
+            "ejecutados": self.ejecutados,
+            "rechazados": self.rechazados,
+            "vencidos": self.vencidos,
+        }
+
+
+ejecutor_comandos = EjecutorComandos()
+
+# ------------------------
+# REGISTRO DE COMANDOS
+# ------------------------
+
+# Cada comando se registra una vez con su nombre y alias; el despacho es un
+# lookup en dict por la primera palabra del mensaje.
+COSTO_BARATO = "barato"    # se responde sin salir del proceso
+COSTO_CARO = "caro"        # consulta APIs o la base
+COMANDOS_CAROS_MAX_COLA = COMANDOS_COLA_MAX // 2   # con la cola así de llena solo se aceptan baratos
+
+
+class Comando:
+    def __init__(self, nombre, funcion, alias=(), args=(), cache=None, costo=COSTO_BARATO, descripcion=""):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.alias = tuple(alias)
+        self.args = tuple(args)
+        self.cache = cache        # clave en cache_respuestas, o None si no se cachea
+        self.costo = costo
+        self.descripcion = descripcion
+        self.llamadas = 0
+        self.errores = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+
+class RegistroComandos:
+    """Índice nombre/alias -> Comando, con contadores y latencia por comando."""
+
+    def __init__(self):
+        self._indice = {}
+        self.comandos = []
+        self.desconocidos = 0
+
+    def registrar(self, nombre, alias=(), args=(), cache=None, costo=COSTO_BARATO, descripcion=""):
+        def decorador(funcion):
+            comando = Comando(nombre, funcion, alias, args, cache, costo, descripcion)
+            for clave in (nombre, *alias):
+                self._indice[clave.lower()] = comando
+            self.comandos.append(comando)
+            return funcion
+        return decorador
+
+    def buscar(self, text):
+        partes = text.split(maxsplit=1)
+        comando = self._indice.get(partes[0].lower()) if partes else None
+        if comando is None:
+            self.desconocidos += 1
+        return comando
+
+    def despachar(self, bot, comando, text, sender_id):
+        # Los argumentos declarados se toman en orden; los que falten quedan en None
+        tokens = text.split()[1:]
+        args = {nombre: (tokens[i] if i < len(tokens) else None) for i, nombre in enumerate(comando.args)}
+        t0 = time.perf_counter()
+        try:
+            datos = cache_respuestas.obtener(comando.cache) if comando.cache else None
+            if ejecutor_comandos.vencido():
+                metricas.inc("comandos_descartados_total", "vencido")
+                bot.logger.warning(f"{comando.nombre} superó {COMANDO_TIMEOUT:.0f}s, no se responde")
+                return
+            comando.funcion(bot, sender_id, args, datos)
+        except Exception:
+            comando.errores += 1
+            metricas.inc("comando_errores_total", comando.nombre)
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            metricas.observar("comando_segundos", dt, comando.nombre)
+            comando.llamadas += 1
+            comando.total_s += dt
+            comando.max_s = max(comando.max_s, dt)
+
+    def estado(self):
+        return {
+            c.nombre: {
+                "llamadas": c.llamadas,
+                "errores": c.errores,
+                "promedio_ms": round(1000 * c.total_s / c.llamadas, 1) if c.llamadas else 0.0,
+                "max_ms": round(1000 * c.max_s, 1),
+                "costo": c.costo,
+            }
+            for c in self.comandos
+        }
+
+
+registro_comandos = RegistroComandos()
+
+
+@registro_comandos.registrar("/cortes", cache="cortes", costo=COSTO_CARO,
+                             descripcion="Cortes eléctricos por empresa (ENRE)")
+def comando_cortes(bot, sender_id, args, mensajes):
+    for i, m in enumerate(mensajes):
+        bot.logger.info(f"\t{Fore.GREEN}Respuesta ({i+1}/{len(mensajes)}): {Style.RESET_ALL}{m}")
+        if ejecutor_comandos.vencido():
+            bot.logger.warning(f"/cortes superó {COMANDO_TIMEOUT:.0f}s, se cancelan {len(mensajes) - i} partes")
+            break
+        # Sin pausas fijas: el planificador las manda a medida que hay airtime
+        planificador_tx.texto(m, destinationId=sender_id)
+
+
+@registro_comandos.registrar("/demanda", cache="demanda", costo=COSTO_CARO,
+                             descripcion="Demanda eléctrica actual y predespacho (CAMMESA)")
+def comando_demanda(bot, sender_id, args, reply):
+    planificador_tx.texto(reply, destinationId=sender_id)
+
+
+@registro_comandos.registrar("/subte", descripcion="Estado de las líneas de subte")
+def comando_subte(bot, sender_id, args, datos):
+    mensajes = obtener_estado_subte_compacto()
+    if ejecutor_comandos.vencido():
+        bot.logger.warning(f"/subte superó {COMANDO_TIMEOUT:.0f}s, no se responde")
+        return
+    for m in mensajes:
+        bot.logger.info(f"\t{Fore.GREEN}Respuesta Subte: {Style.RESET_ALL}{m}")
+        planificador_tx.texto(m, destinationId=sender_id)
+
+
+@registro_comandos.registrar("/ping", descripcion="Responde pong")
+def comando_ping(bot, sender_id, args, datos):
+    planificador_tx.texto("pong", destinationId=sender_id)
+
+# ------------------------
+# DIRECTORIO DE NODOS
+# ------------------------
+
+# Etiquetas de nodos en memoria, indexadas por id numérico y por "!hex".
+# Se guardan en disco para que después de reiniciar los nombres aparezcan
+# enseguida, sin esperar los NODEINFO ni la sincronización con la radio.
+NODOS_PATH = "midoluz_nodos.json"
+NODOS_SNAPSHOT_INTERVALO = 300.0   # segundos entre guardados (solo si hubo cambios)
+
+
+class DirectorioNodos:
+    """Índice num/!hex -> datos del nodo, actualizado con cada NODEINFO y guardado periódicamente."""
+
+    def __init__(self, ruta=NODOS_PATH, intervalo=NODOS_SNAPSHOT_INTERVALO):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self._indice = {}
+        self._cambios = False
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def etiqueta(self, node_id):
+        info = self._indice.get(node_id)
+        return info["shortName"] if info else None
+
+    def actualizar(self, num, user):
+        """num puede venir como None: en ese caso se deduce del "!hex" del propio user."""
+        hex_id = user.get("id")
+        if num is None and isinstance(hex_id, str) and hex_id.startswith("!"):
+            try:
+                num = int(hex_id[1:], 16)
+            except ValueError:
+                return
+        if not isinstance(num, int) or not user.get("shortName"):
+            return
+        info = {
+            "num": num,
+            "shortName": user.get("shortName"),
+            "longName": user.get("longName"),
+            "hwModel": user.get("hwModel"),
+        }
+        with self._lock:
+            if self._indice.get(num) == info:
+                return
+            self._indice[num] = info
+            self._indice[f"!{num:08x}"] = info
+            self._cambios = True
+
+    def cargar_de_interfaz(self, nodes):
+        """Suma lo que la radio ya conoce (interface.nodes) al directorio."""
+        for node in list((nodes or {}).values()):
+            self.actualizar(node.get("num"), node.get("user", {}))
+
+    def cargar(self):
+        try:
+            with open(self.ruta, encoding="utf-8") as fh:
+                nodos = json.load(fh)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logging.getLogger("MeshBot").error(f"{Fore.RED}[NODOS] No se pudo leer {self.ruta}: {e}{Style.RESET_ALL}")
+            return 0
+        for info in nodos:
+            self.actualizar(info.get("num"), info)
+        self._cambios = False
+        return len(nodos)
+
+    def guardar(self):
+        with self._lock:
+            if not self._cambios:
+                return
+            # Cada nodo está dos veces en el índice; se guarda una sola
+            nodos = [info for clave, info in self._indice.items() if isinstance(clave, int)]
+            self._cambios = False
+        try:
+            tmp = self.ruta + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(nodos, fh, ensure_ascii=False)
+            os.replace(tmp, self.ruta)
+        except Exception as e:
+            self._cambios = True
+            logging.getLogger("MeshBot").error(f"{Fore.RED}[NODOS] No se pudo guardar {self.ruta}: {e}{Style.RESET_ALL}")
+
+    def start(self):
+        self._hilo = threading.Thread(target=self._loop, name="DirectorioNodos", daemon=True)
+        self._hilo.start()
+
+    def stop(self):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(5)
+        self.guardar()
+
+    def _loop(self):
+        while not self._detener.wait(self.intervalo):
+            self.guardar()
+
+
+directorio_nodos = DirectorioNodos()
+
+
+# ------------------------
+# DEDUPLICACIÓN DE PAQUETES
+# ------------------------
+
+# Por rebroadcasts y caminos múltiples el mismo paquete llega más de una vez.
+# Solo se procesa la primera copia; las demás suman al contador de esa copia.
+DEDUP_VENTANA_S = 600      # segundos que se recuerda un paquete
+DEDUP_MAX = 5000           # tope de entradas (memoria fija)
+
+
+class IndiceDuplicados:
+    """Conjunto (emisor, id de paquete) con ventana de tiempo y tamaño máximo, O(1) por chequeo."""
+
+    def __init__(self, ventana=DEDUP_VENTANA_S, maximo=DEDUP_MAX):
+        self.ventana = ventana
+        self.maximo = maximo
+        self.duplicados = 0
+        self._vistos = OrderedDict()     # clave -> (monotonic de la primera copia, meta)
+        self._lock = threading.Lock()
+
+    def registrar(self, clave, meta, fusionar=None):
+        """Devuelve None si es la primera copia, o el meta de la primera copia si es un duplicado.
+
+        fusionar(previo, meta) suma la copia al meta de la primera con el lock tomado, así
+        dos copias no se pisan. El escritor de DB no toma este lock: serializa el meta tal
+        como esté cuando arma el lote, y las copias que lleguen después ya no se guardan.
+        """
+        ahora = time.monotonic()
+        with self._lock:
+            # Las entradas están en orden de llegada: las vencidas quedan al principio
+            while self._vistos:
+                primera = next(iter(self._vistos.values()))
+                if ahora - primera[0] < self.ventana:
+                    break
+                self._vistos.popitem(last=False)
+
+            previo = self._vistos.get(clave)
+            if previo is not None:
+                self.duplicados += 1
+                if fusionar is not None:
+                    fusionar(previo[1], meta)
+                return previo[1]
+
+            self._vistos[clave] = (ahora, meta)
+            if len(self._vistos) > self.maximo:
+                self._vistos.popitem(last=False)
+            return None
+
+    def estado(self):
+        return {"en_ventana": len(self._vistos), "duplicados": self.duplicados}
+
+
+indice_duplicados = IndiceDuplicados()
+
+
+def fusionar_copia(previo, copia):
+    """Suma una copia repetida a la primera: hops mínimos y la recepción de cada radio que la oyó."""
+    previo["duplicados"] += 1
+    hops = copia["hops"]
+    if hops is not None and (previo["hops_min"] is None or hops < previo["hops_min"]):
+        previo["hops_min"] = hops
+    recepcion = copia["radios"][0]
+    # Por radio se guarda la primera copia que oyó (la que llegó antes). Se reemplaza la
+    # lista en vez de agregarle: el escritor de DB puede estar recorriendo la anterior.
+    if all(r["radio"] != recepcion["radio"] for r in previo["radios"]):
+        previo["radios"] = previo["radios"] + [recepcion]
+        copia["primera_de_radio"] = True
+
+
+# ------------------------
+# SUPERVISOR DE CONEXIÓN
+# ------------------------
+
+# Nodos a los que se puede conectar el bot por la API TCP de Meshtastic
+# ("host" o "host:puerto"), en orden de preferencia. Se pueden pisar al
+# arrancar repitiendo --nodo, por ejemplo contra simulador_nodo.py:
+#   python3 midoluzbotv4.py --nodo 127.0.0.1 --nodo 192.168.0.157
+NODO_DIRECCION = "IP_NODO"
+NODOS_RESPALDO = []            # se prueban si el principal no responde
+NODO_PUERTO_TCP = 4403
+RADIO_PRINCIPAL = "principal"  # nombre de esta radio en la DB y en /metrics (ver RADIOS_ESCUCHA)
+
+# Apenas meshtastic avisa que se perdió la conexión se reintenta: primero el
+# mismo nodo, después los de respaldo. Si ninguna vuelta funciona se espera un
+# tiempo al azar entre 0 y base * 2^vuelta (tope RECONEXION_MAX_S) para que
+# varios bots no golpeen al nodo todos juntos cuando vuelve.
+RECONEXION_BASE_S = 1.0
+RECONEXION_MAX_S = 60.0
+RECONEXION_TIMEOUT_TCP_S = 5.0   # un nodo apagado no debe bloquear minutos en el connect
+CONEXION_TIMEOUT_CONFIG_S = 30   # espera de la config (meshtastic: 300s; aparte, su connect ya corta a los 30s)
+CIERRE_ESPERA_S = 5.0            # al apagar, cuánto se espera a que cierre cada interfaz
+CONEXION_VIGIA_S = 15.0          # chequeo de respaldo por si el evento de pubsub no llega
+CORTES_HISTORIAL = 50            # cortes recordados para /ConnectionStatus
+
+
+class SupervisorConexion:
+    """Detecta la caída de la radio por pubsub, reconecta con backoff y failover y registra cada corte.
+
+    radio es cualquier objeto con interface, direccion y connect(direccion): el bot
+    (radio principal) o una RadioEscucha.
+    """
+
+    def __init__(self, nombre=RADIO_PRINCIPAL, direcciones=None):
+        self.nombre = nombre
+        self.direcciones = direcciones   # None: NODO_DIRECCION y NODOS_RESPALDO
+        self.radio = None
+        self.recibidos = 0               # paquetes recibidos (lo incrementa on_receive)
+        self.tasa = 0.0                  # paquetes/s recientes, para estimar lo perdido en un corte
+        self.conectado_desde = None
+        self.cortes = deque(maxlen=CORTES_HISTORIAL)
+        self.total_cortes = 0
+        self.total_perdidos = 0
+        self._corte = None               # corte en curso
+        self._caida = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def candidatos(self):
+        if self.direcciones is not None:
+            return list(self.direcciones)
+        return [NODO_DIRECCION] + [n for n in NODOS_RESPALDO if n != NODO_DIRECCION]
+
+    def start(self, radio):
+        self.radio = radio
+        pub.subscribe(self._on_perdida, "meshtastic.connection.lost")
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._loop, name=f"SupervisorConexion-{self.nombre}", daemon=True)
+        self._hilo.start()
+
+    def stop(self):
+        self._detener.set()
+        self._caida.set()
+        if self._hilo:
+            self._hilo.join(5)
+
+    def _on_perdida(self, interface):
+        # Los avisos de interfaces viejas (ya reemplazadas) no cuentan
+        if self.radio is not None and interface is self.radio.interface:
+            self._caida.set()
+
+    def _conectada(self):
+        interfaz = self.radio.interface
+        if interfaz is None or getattr(interfaz, "failure", None):
+            return False
+        conectada = getattr(interfaz, "isConnected", None)
+        return conectada.is_set() if conectada is not None else True
+
+    def _loop(self):
+        log = logging.getLogger("MeshBot")
+        ultimo_conteo, ultimo_t = self.recibidos, time.monotonic()
+        while not self._detener.is_set():
+            if self.radio.interface is not None and self._conectada():
+                self._caida.wait(CONEXION_VIGIA_S)
+                self._caida.clear()
+                if self._detener.is_set():
+                    return
+                ahora = time.monotonic()
+                if ahora > ultimo_t:
+                    instantanea = (self.recibidos - ultimo_conteo) / (ahora - ultimo_t)
+                    self.tasa = instantanea if not self.tasa else 0.7 * self.tasa + 0.3 * instantanea
+                ultimo_conteo, ultimo_t = self.recibidos, ahora
+                if self._conectada():
+                    continue
+
+            self._reconectar(log)
+            ultimo_conteo, ultimo_t = self.recibidos, time.monotonic()
+
+    def _reconectar(self, log):
+        anterior = self.radio.interface
+        actual = self.radio.direccion
+        if anterior is not None:
+            self._corte = {
+                "inicio": datetime.now(),
+                "_t0": time.monotonic(),
+                "nodo_caido": actual,
+                "tasa_previa": round(self.tasa, 3),
+            }
+            log.warning(f"[{self.nombre}] Conexión perdida con {actual}. Reconectando...")
+            # Sin interfaz, los envíos y el REST responden "no conectado" en vez de fallar contra el socket
+            self.radio.interface = None
+            self.conectado_desde = None
+            # close() espera al hilo lector, que puede estar trabado en el reconnect
+            # interno de meshtastic (sin timeout): se cierra en segundo plano
+            cerrar_interfaz(anterior)
+
+        orden = [actual] + [c for c in self.candidatos() if c != actual]
+        vuelta = 0
+        intentos = 0
+        while not self._detener.is_set():
+            for direccion in orden:
+                intentos += 1
+                if self._alcanzable(direccion) and self.radio.connect(direccion):
+                    metricas.inc("reconexiones_total", self.nombre, "ok")
+                    self._conexion_ok(direccion, intentos, log)
+                    return
+                metricas.inc("reconexiones_total", self.nombre, "error")
+                if self._detener.is_set():
+                    return
+            espera = random.uniform(0, min(RECONEXION_MAX_S, RECONEXION_BASE_S * 2 ** vuelta))
+            log.error(f"[{self.nombre}] Ningún nodo respondió ({', '.join(orden)}). Reintentando en {espera:.1f}s")
+            vuelta += 1
+            if self._detener.wait(espera):
+                return
+
+    @staticmethod
+    def _alcanzable(direccion):
+        try:
+            socket.create_connection(host_puerto(direccion), timeout=RECONEXION_TIMEOUT_TCP_S).close()
+            return True
+        except OSError:
+            return False
+
+    def _conexion_ok(self, direccion, intentos, log):
+        self.conectado_desde = datetime.now()
+        corte, self._corte = self._corte, None
+        if corte is None:
+            log.info(f"[{self.nombre}] Conectado a {direccion}")
+            return
+
+        duracion = time.monotonic() - corte.pop("_t0")
+        perdidos = round(corte["tasa_previa"] * duracion)
+        inicio = corte["inicio"]
+        corte.update({
+            "inicio": inicio.isoformat(timespec="seconds"),
+            "fin": self.conectado_desde.isoformat(timespec="seconds"),
+            "duracion_s": round(duracion, 1),
+            "nodo_nuevo": direccion,
+            "intentos": intentos,
+            "paquetes_perdidos_estimados": perdidos,
+            "nodos_activos_durante_corte": self._nodos_oidos_desde(inicio),
+        })
+        self.cortes.append(corte)
+        self.total_cortes += 1
+        self.total_perdidos += perdidos
+        metricas.observar("corte_segundos", duracion, self.nombre)
+        metricas.inc("paquetes_perdidos_estimados_total", self.nombre, valor=perdidos)
+        cambio = f" (failover desde {corte['nodo_caido']})" if direccion != corte["nodo_caido"] else ""
+        log.warning(f"[{self.nombre}] Reconectado a {direccion}{cambio} tras {duracion:.1f}s; ~{perdidos} paquetes perdidos")
+
+    def _nodos_oidos_desde(self, inicio):
+        # La radio siguió escuchando: lastHeard de su NodeDB dice quién habló mientras no la leíamos
+        desde = inicio.timestamp()
+        nodos = getattr(self.radio.interface, "nodes", None) or {}
+        return sum(1 for n in nodos.values() if (n.get("lastHeard") or 0) >= desde)
+
+    def estado(self):
+        return {
+            "radio": self.nombre,
+            "conectado": self.radio is not None and self.radio.interface is not None and self._conectada(),
+            "nodo": self.radio.direccion if self.radio else None,
+            "candidatos": self.candidatos(),
+            "conectado_desde": self.conectado_desde.isoformat(timespec="seconds") if self.conectado_desde else None,
+            "paquetes_recibidos": self.recibidos,
+            "paquetes_por_s": round(self.tasa, 3),
+            "cortes_totales": self.total_cortes,
+            "paquetes_perdidos_estimados": self.total_perdidos,
+            "cortes": list(self.cortes),
+        }
+
+
+supervisor_conexion = SupervisorConexion()
+
+
+def host_puerto(direccion):
+    host, _, puerto = direccion.partition(":")
+    return host, int(puerto) if puerto else NODO_PUERTO_TCP
+
+
+def abrir_interfaz_tcp(direccion):
+    host, puerto = host_puerto(direccion)
+    interfaz = meshtastic.tcp_interface.TCPInterface(
+        hostname=host, portNumber=puerto, timeout=CONEXION_TIMEOUT_CONFIG_S
+    )
+    directorio_nodos.cargar_de_interfaz(interfaz.nodes)
+    return interfaz
+
+
+def cerrar_interfaz(interfaz, espera=None):
+    """Cierra la interfaz en un hilo aparte; espera (segundos) acota cuánto se lo aguarda."""
+    def _cerrar():
+        try:
+            interfaz.close()
+        except Exception:
+            pass
+    hilo = threading.Thread(target=_cerrar, name="CerrarInterfaz", daemon=True)
+    hilo.start()
+    if espera:
+        hilo.join(espera)
+
+
+# ------------------------
+# RADIOS DE ESCUCHA
+# ------------------------
+
+# Nodos de otros sitios conectados a la vez que el principal ("host", "host:puerto"
+# o "nombre=host:puerto"), para cubrir más área con un solo proceso y un solo
+# escritor de DB. Cada uno tiene su hilo lector y su supervisor; meshtastic publica
+# los paquetes de todas las interfaces desde su único publishingThread, así que
+# on_receive los atiende de a uno. El índice de duplicados los junta entre radios,
+# guardando en _mesh.radios el RSSI, SNR, hops y hora de llegada de cada radio que
+# oyó el paquete. Solo escuchan: los comandos y los ACK se atienden únicamente
+# cuando los oye la principal, que es la que transmite las respuestas y los envíos.
+#   python3 midoluzbotv4.py --nodo 192.168.0.156 --radio sur=10.8.0.12 --radio 10.8.0.20
+RADIOS_ESCUCHA = []
+
+
+class RadioEscucha:
+    """Conexión adicional a un nodo Meshtastic que solo aporta recepción."""
+
+    def __init__(self, nombre, direccion):
+        self.nombre = nombre
+        self.direccion = direccion
+        self.host_puerto = host_puerto(direccion)
+        self.interface = None
+        self.supervisor = SupervisorConexion(nombre, [direccion])
+
+    def connect(self, address):
+        try:
+            logging.getLogger("MeshBot").info(f"[{self.nombre}] Conectando a {address}...")
+            self.direccion = address
+            self.host_puerto = host_puerto(address)
+            self.interface = abrir_interfaz_tcp(address)
+            return True
+        except Exception as e:
+            logging.getLogger("MeshBot").error(f"[{self.nombre}] Error conexión: {e}")
+            return False
+
+
+class FlotaRadios:
+    """Las radios de escucha configuradas, y a qué radio pertenece cada interfaz."""
+
+    def __init__(self):
+        self.escucha = []
+
+    def configurar(self, direcciones):
+        self.escucha = []
+        for entrada in direcciones:
+            nombre, _, direccion = entrada.rpartition("=")
+            self.escucha.append(RadioEscucha(nombre or direccion, direccion))
+
+    def radio_de(self, interface, principal):
+        if not self.escucha:
+            return principal
+        # Por host y puerto: durante la descarga de la config ya llegan paquetes y
+        # radio.interface todavía no está asignada (el constructor no volvió)
+        clave = (getattr(interface, "hostname", None), getattr(interface, "portNumber", None))
+        for radio in self.escucha:
+            if radio.interface is interface or radio.host_puerto == clave:
+                return radio
+        return principal
+
+    def supervisores(self):
+        return [supervisor_conexion] + [radio.supervisor for radio in self.escucha]
+
+    def start(self):
+        for radio in self.escucha:
+            radio.supervisor.start(radio)
+
+    def stop(self):
+        for radio in self.escucha:
+            radio.supervisor.stop()
+            if radio.interface:
+                cerrar_interfaz(radio.interface, CIERRE_ESPERA_S)
+                radio.interface = None
+
+    def estado(self):
+        return [supervisor.estado() for supervisor in self.supervisores()]
+
+
+flota_radios = FlotaRadios()
+
 
 # ------------------------
 # Clase Principal del Bot
@@ -375,14 +3299,13 @@ class MeshtasticCommandBot:
 
     def __init__(self):
         self.interface = None
+        self.direccion = NODO_DIRECCION
+        self.nombre = RADIO_PRINCIPAL
+        self.supervisor = supervisor_conexion
         self.setup_logging()
 
     def setup_logging(self):
-        log_format = (
-            f"{Fore.WHITE}{Style.DIM}%(asctime)s{Style.RESET_ALL} "
-            f"{Fore.GREEN}{Style.BRIGHT}[%(levelname)s]{Style.RESET_ALL} %(message)s"
-        )
-        logging.basicConfig(level=logging.INFO, format=log_format, datefmt='%H:%M:%S')
+        configurar_logging()
         self.logger = logging.getLogger("MeshBot")
         self.logger.info(
             f"{Fore.MAGENTA}{Style.BRIGHT}MidoLuz-Bot REST activo{Style.RESET_ALL}"
@@ -390,41 +3313,80 @@ class MeshtasticCommandBot:
 
     def get_node_label(self, node_id):
         if node_id == 0xffffffff or node_id == "^all": return "ALL"
-        try:
-            if node_id in self.interface.nodes:
-                return self.interface.nodes[node_id]["user"]["shortName"]
-        except: pass
+        nombre = directorio_nodos.etiqueta(node_id)
+        if nombre:
+            return nombre
         return f"!{node_id:08x}" if isinstance(node_id, int) else str(node_id)
 
     def connect(self, address):
         try:
             self.logger.info(f"Conectando a {address}...")
-            self.interface = meshtastic.tcp_interface.TCPInterface(hostname=address)
+            self.direccion = address
+            self.interface = abrir_interfaz_tcp(address)
             return True
         except Exception as e:
             self.logger.error(f"Error conexión: {e}")
             return False
 
+    @staticmethod
+    def _etapa(nombre, t0):
+        """Anota cuánto tardó una etapa de on_receive y devuelve el inicio de la siguiente."""
+        ahora = time.perf_counter()
+        if ETAPAS_ON_RECEIVE:
+            metricas.observar("on_receive_etapa_segundos", ahora - t0, nombre)
+        return ahora
+
     def on_receive(self, packet, interface):
+        t = time.perf_counter()
+        # Todas las radios llegan por el publishingThread de meshtastic: se distinguen por la interfaz
+        radio = flota_radios.radio_de(interface, self)
+        radio.supervisor.recibidos += 1
         try:
+            # Hops recorridos por esta copia (si el firmware manda hopStart)
+            hop_start = packet.get("hopStart")
+            hop_limit = packet.get("hopLimit")
+            hops = hop_start - hop_limit if hop_start is not None and hop_limit is not None else None
+            recepcion = {
+                "radio": radio.nombre, "rssi": packet.get("rxRssi"), "snr": packet.get("rxSnr"),
+                "hops": hops, "llegada": round(time.time(), 3),
+            }
+            meta_mesh = {"hops": hops, "hops_min": hops, "duplicados": 0, "radios": [recepcion]}
+
+            packet_id = packet.get("id")
+            if packet_id:
+                # Se anota en la primera copia; llega a la DB si el lote todavía no se escribió
+                previo = indice_duplicados.registrar((packet.get("from"), packet_id), meta_mesh, fusionar_copia)
+                if previo is not None:
+                    metricas.inc("paquetes_duplicados_total")
+                    # Si una radio de escucha lo oyó antes, los comandos y ACK se atienden
+                    # con la primera copia que llega a la principal
+                    if radio is self and meta_mesh.get("primera_de_radio"):
+                        self._atender(packet)
+                    self._etapa("dedup", t)
+                    return
+            metricas.inc("paquetes_primera_copia_total", radio.nombre)
+            t = self._etapa("dedup", t)
+            if radio is self:
+                self._atender(packet)
+
             decoded = packet.get("decoded", {})
             port = decoded.get("portnum")
+            metricas.inc("paquetes_recibidos_total", port or "SIN_DECODIFICAR")
             from_id = packet.get("fromId")
             dest_id = packet.get("toId")
             
             sender = self.get_node_label(from_id)
             dest = self.get_node_label(dest_id)
-            peers = f"{Fore.CYAN}{Style.BRIGHT}{sender:>6}{Style.RESET_ALL} -> {Fore.YELLOW}{Style.BRIGHT}{dest:<6}"
+            t = self._etapa("etiquetas", t)
             # Extract data para la DB
             payload_db = {}
             tipo_db = port
+            campos = None
             # --- TEXT MESSAGES ---
             if port == "TEXT_MESSAGE_APP":
                 text = decoded.get("text", "").strip()
                 payload_db = {"text": text}
-                self.logger.info(f"{Fore.WHITE}{Style.BRIGHT}{'Text Message':<18} {peers} {Fore.MAGENTA}Msg: {text}")
-                if text.startswith("/"):
-                    self.handle_command(text, from_id, sender)
+                campos = {"text": text}
 
             # --- POSITION ---
             elif port == "POSITION_APP":
@@ -439,15 +3401,16 @@ class MeshtasticCommandBot:
                 lat = pos.get("latitude")
                 lon = pos.get("longitude")
                 alt = pos.get("altitude", 0)
-                self.logger.info(f"{Fore.BLUE}{Style.BRIGHT}{'Position':<18} {peers} {Style.DIM}Lat: {lat}, Lon: {lon}, Alt: {alt}m")
+                campos = {"lat": lat, "lon": lon, "alt": alt}
 
             # --- NODE INFO ---
             elif port == "NODEINFO_APP":
                 user = decoded.get("user", {})
                 payload_db = user
+                directorio_nodos.actualizar(packet.get("from"), user)
                 name = user.get("longName", "???")
                 hw = user.get("hwModel", "???")
-                self.logger.info(f"{Fore.YELLOW}{Style.BRIGHT}{'Node Info':<18} {peers} {Style.DIM}Name: {name} | HW: {hw}")
+                campos = {"name": name, "hw": hw}
 
             # --- TELEMETRY ---
             elif port == "TELEMETRY_APP":
@@ -455,85 +3418,97 @@ class MeshtasticCommandBot:
                 payload_db = tel
                 volt = tel.get("voltage", 0)
                 bat = tel.get("batteryLevel", 0)
-                self.logger.info(f"{Fore.MAGENTA}{Style.BRIGHT}{'Telemetry':<18} {peers} {Style.DIM}Volt: {volt}V, Bat: {bat}%")
+                campos = {"volt": volt, "bat": bat}
 
             # --- ROUTING ---
             elif port == "ROUTING_APP":
                 payload_db = {"raw": str(decoded)}
-                self.logger.info(f"{Fore.CYAN}{Style.DIM}{'Routing':<18} {peers} {Style.DIM}Mesh Routing Packet")
+                campos = {}
 
             # --- RANGE TEST ---
             elif port == "RANGE_TEST_APP":
                 payload = decoded.get("payload", "")
                 payload_db = {"raw": str(decoded)}
-                self.logger.info(f"{Fore.GREEN}{Style.BRIGHT}{'Range Test':<18} {peers} {Style.DIM}Seq: {payload}")
+                campos = {"seq": payload}
 
             # --- DETECTION SENSOR ---
             elif port == "DETECTION_SENSOR_APP":
                 payload_db = {"raw": str(decoded)}
-                self.logger.info(f"{Fore.RED}{Style.BRIGHT}{'Sensor Alert':<18} {peers} {Fore.RED}SENSOR TRIGGERED")
+                campos = {}
 
             # --- ADMIN ---
             elif port == "ADMIN_APP":
                 payload_db = {"raw": str(decoded)}
-                self.logger.info(f"{Fore.RED}{'Admin':<18} {peers} Admin Config Packet")
+                campos = {}
+            t = self._etapa("decodificacion", t)
+
+            if campos is not None:
+                # Solo se encola el record: la línea (o el JSON) la arma el hilo de logging
+                self.logger.info("%s %s -> %s", port, sender, dest,
+                                 extra={"paquete": {"tipo": port, "de": sender, "a": dest, **campos}})
+            t = self._etapa("log", t)
+
             # LLAMADA A LA BASE DE DATOS
             registrar_en_db(
                 tipo=tipo_db,
                 emisor_id=f"{from_id:08x}" if isinstance(from_id, int) else str(from_id),
                 emisor_name=sender,
                 receptor_id=f"{dest_id:08x}" if isinstance(dest_id, int) else str(dest_id),
-                extra_data=payload_db
+                extra_data={**payload_db, "_mesh": meta_mesh}
             )
+            self._etapa("encolado_db", t)
 
         except Exception as e:
             self.logger.error(f"Error procesando paquete: {e}")
 
-    def handle_command(self, text, sender_id, sender_name):
-        cmd = text.lower()
-        if "/cortes" in cmd:
-            mensajes = obtener_cortes_por_empresa()
-            for i, m in enumerate(mensajes):
-                self.logger.info(f"\t{Fore.GREEN}Respuesta ({i+1}/{len(mensajes)}): {Style.RESET_ALL}{m}")
-                self.interface.sendText(m, destinationId=sender_id)
-                if i < len(mensajes) - 1: time.sleep(5)
-        elif "/demanda" in cmd:
-            reply = obtener_demanda_compacta()
-            self.interface.sendText(reply, destinationId=sender_id)
-        elif "/subte" in cmd:
-            reply = obtener_estado_subte_compacto()
-            self.logger.info(f"\t{Fore.GREEN}Respuesta Subte: {Style.RESET_ALL}{reply}")
-            self.interface.sendText(reply, destinationId=sender_id)
-        elif "/ping" in cmd:
-            self.interface.sendText("pong", destinationId=sender_id)
+    def _atender(self, packet):
+        """Comandos y ACK de envíos propios: solo con paquetes que oyó la radio principal."""
+        decoded = packet.get("decoded", {})
+        port = decoded.get("portnum")
+        if port == "TEXT_MESSAGE_APP":
+            text = decoded.get("text", "").strip()
+            if text.startswith("/"):
+                comando = registro_comandos.buscar(text)
+                if comando:
+                    self.encolar_comando(comando, text, packet.get("fromId"))
+        elif port == "ROUTING_APP" and decoded.get("requestId"):
+            planificador_tx.confirmar(
+                decoded["requestId"], decoded.get("routing", {}).get("errorReason"), packet.get("from")
+            )
+
+    def on_node_updated(self, node, interface=None):
+        directorio_nodos.actualizar(node.get("num"), node.get("user", {}))
+
+    def encolar_comando(self, comando, text, sender_id):
+        # Con la cola medio llena se priorizan los comandos que no salen a internet
+        if comando.costo == COSTO_CARO and ejecutor_comandos.cola.qsize() >= COMANDOS_CAROS_MAX_COLA:
+            metricas.inc("comandos_descartados_total", "cola_cargada")
+            self.logger.warning(f"Cola de comandos cargada, se ignora {comando.nombre}")
+            return
+        if not ejecutor_comandos.enviar(self.handle_command, comando, text, sender_id):
+            metricas.inc("comandos_descartados_total", "cola_llena")
+            self.logger.warning(f"Cola de comandos llena, se ignora: {text}")
+
+    def handle_command(self, comando, text, sender_id):
+        registro_comandos.despachar(self, comando, text, sender_id)
 
 
     def start(self):
             pub.subscribe(self.on_receive, "meshtastic.receive")
+            pub.subscribe(self.on_node_updated, "meshtastic.node.updated")
             self.logger.info("Escuchando red Meshtastic...")
 
-            try:
-                while True:
-                    # Verificar si la interfaz existe y si no está cerrada
-                    if not self.interface or self.interface.failure:
-                        self.logger.warning("Conexión perdida. Intentando reconectar...")
-                        if self.connect("192.168.0.156"):
-                            self.logger.info("Reconectado con éxito.")
-                        else:
-                            self.logger.error("Fallo al reconectar. Reintentando en 10s...")
-                            time.sleep(10)
-                            continue
-                    
-                    time.sleep(5) # Un check cada 5 segundos es suficiente
-            except KeyboardInterrupt:
-                if self.interface:
-                    self.interface.close()
+            # La conexión (la primera y las reconexiones) la maneja el supervisor
+            supervisor_conexion.start(self)
+            flota_radios.start()
             try:
                 while True:
                     time.sleep(1)
             except KeyboardInterrupt:
+                supervisor_conexion.stop()
+                flota_radios.stop()
                 if self.interface:
-                    self.interface.close()
+                    cerrar_interfaz(self.interface, CIERRE_ESPERA_S)
 
 
 # ------------------------
@@ -541,13 +3516,60 @@ class MeshtasticCommandBot:
 # ------------------------
 
 if __name__ == "__main__":
+    if "--mantenimiento" in sys.argv:
+        # Corrida única (cron o a mano) sin conectarse a la radio
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%H:%M:%S")
+        if "--migrar" in sys.argv:
+            migrada = mantenimiento_eventos.migrar()
+            print("eventos convertida a tabla particionada" if migrada else "eventos ya estaba particionada")
+        mantenimiento_eventos.correr(forzar="--forzar" in sys.argv)
+        sys.exit(0)
+
+    nodos_cli = [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1]) if arg == "--nodo"]
+    if nodos_cli:
+        NODO_DIRECCION, NODOS_RESPALDO = nodos_cli[0], nodos_cli[1:]
+    radios_cli = [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1]) if arg == "--radio"]
+    if radios_cli:
+        RADIOS_ESCUCHA = radios_cli
+    flota_radios.configurar(RADIOS_ESCUCHA)
+    if "--log-json" in sys.argv:
+        LOG_MODO = "json"
+
     bot = MeshtasticCommandBot()
     mesh_bot_instance = bot
+    cargados = directorio_nodos.cargar()
+    if cargados:
+        bot.logger.info(f"Directorio de nodos: {cargados} nodos cargados de {NODOS_PATH}")
+    directorio_nodos.start()
+    spool_local.start()
+    escritor_db.start()
+    ejecutor_comandos.start()
+    planificador_tx.start()
+    estado_subte.start()
+    if ROLLUPS:
+        agregador_rollups.start()
+    mantenimiento_eventos.start()
+    cliente_http.calentar([URL_CORTES, URL_DEMANDA])
+    if CACHE_PRECARGA:
+        cache_respuestas.start_precarga()
 
-    if bot.connect("IP_NODO"):
-
+    try:
         # API REST paralela mediante threading
         threading.Thread(target=start_rest_api, daemon=True).start()
 
         bot.start()
+    finally:
+        # Último flush de lo que haya quedado en la cola
+        supervisor_conexion.stop()
+        flota_radios.stop()
+        ejecutor_comandos.stop()
+        planificador_tx.stop()
+        cache_respuestas.stop()
+        estado_subte.stop()
+        agregador_rollups.stop()
+        mantenimiento_eventos.stop()
+        escritor_db.stop()
+        spool_local.stop()
+        directorio_nodos.stop()
+        detener_logging()
 
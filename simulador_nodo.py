@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# MidoLuzBot - Nodo Meshtastic simulado por TCP
+#
+# Reemplaza a la radio para probar el bot sin hardware: escucha en el puerto
+# de la API TCP de Meshtastic (4403), habla el mismo framing (0x94 0xC3 + largo
+# + protobuf), contesta el handshake de configuración y después emite tráfico
+# según un perfil. Todo lo que el bot transmite queda grabado en un JSONL.
+#
+#   python3 simulador_nodo.py --perfil tormenta --grabar enviados.jsonl
+#   python3 midoluzbotv4.py --nodo 127.0.0.1
+#
+# Perfiles:
+#   tormenta   muchos paquetes por segundo, con copias repetidas por varios caminos
+#   rafagas    ráfagas de mensajes de texto (con comandos) separadas por silencios
+#   goteo      un paquete cada tantos segundos, para pruebas largas
+#   cortes     tráfico normal, cortando la conexión y dejando el nodo caído un rato
+#   mixto      los anteriores en secuencia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import base64
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from meshtastic.protobuf import channel_pb2, mesh_pb2, portnums_pb2, telemetry_pb2
+
+START1 = 0x94
+START2 = 0xC3
+MAX_FRAME = 512
+BROADCAST = 0xFFFFFFFF
+
+NODO_PROPIO = 0x5EED0001
+COMANDOS = ("/ping", "/subte", "/demanda", "/cortes")
+
+
+# ------------------------
+# FRAMING
+# ------------------------
+
+def frame(mensaje):
+    datos = mensaje.SerializeToString()
+    return struct.pack(">BBH", START1, START2, len(datos)) + datos
+
+
+def leer_frames(sock):
+    """Devuelve los payloads que llegan por el socket; ignora bytes sueltos entre frames
+    (el cliente manda 0xC3 repetidos al conectar para despertar a la radio)."""
+    buffer = bytearray()
+    while True:
+        datos = sock.recv(4096)
+        if not datos:
+            return
+        buffer.extend(datos)
+        while True:
+            inicio = buffer.find(bytes((START1, START2)))
+            if inicio < 0:
+                # Conservamos un posible START1 al final
+                del buffer[:max(0, len(buffer) - 1)]
+                break
+            del buffer[:inicio]
+            if len(buffer) < 4:
+                break
+            largo = (buffer[2] << 8) | buffer[3]
+            if largo > MAX_FRAME:
+                del buffer[:2]
+                continue
+            if len(buffer) < 4 + largo:
+                break
+            yield bytes(buffer[4:4 + largo])
+            del buffer[:4 + largo]
+
+
+# ------------------------
+# SESIÓN CON UN CLIENTE
+# ------------------------
+
+class Sesion:
+    """Una conexión TCP del bot: handshake de configuración y lectura de lo que transmite."""
+
+    def __init__(self, simulador, sock, direccion):
+        self.simulador = simulador
+        self.sock = sock
+        self.direccion = direccion
+        self.configurada = False
+        self._lock = threading.Lock()
+
+    def enviar(self, from_radio):
+        try:
+            with self._lock:
+                self.sock.sendall(frame(from_radio))
+            return True
+        except OSError:
+            return False
+
+    def cerrar(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _configurar(self, config_id):
+        sim = self.simulador
+        mensajes = [mesh_pb2.FromRadio(my_info=mesh_pb2.MyNodeInfo(my_node_num=NODO_PROPIO))]
+        for num, usuario in sim.nodos.items():
+            mensajes.append(mesh_pb2.FromRadio(node_info=mesh_pb2.NodeInfo(num=num, user=usuario)))
+        canal = channel_pb2.Channel(index=0, role=channel_pb2.Channel.Role.PRIMARY)
+        canal.settings.name = "Simulado"
+        mensajes.append(mesh_pb2.FromRadio(channel=canal))
+        mensajes.append(mesh_pb2.FromRadio(config_complete_id=config_id))
+        for m in mensajes:
+            self.enviar(m)
+        self.configurada = True
+
+    def atender(self):
+        try:
+            for datos in leer_frames(self.sock):
+                to_radio = mesh_pb2.ToRadio()
+                try:
+                    to_radio.ParseFromString(datos)
+                except Exception:
+                    self.simulador.contar("frames_invalidos")
+                    continue
+                if to_radio.HasField("want_config_id"):
+                    self._configurar(to_radio.want_config_id)
+                elif to_radio.HasField("packet"):
+                    self.simulador.recibido_del_bot(self, to_radio.packet)
+                elif to_radio.HasField("disconnect"):
+                    break
+        except OSError:
+            pass
+        finally:
+            self.configurada = False
+            self.simulador.quitar(self)
+            self.cerrar()
+
+
+# ------------------------
+# SIMULADOR
+# ------------------------
+
+class NodoSimulado:
+    def __init__(self, host, puerto, nodos, duplicados, ack, grabar, semilla):
+        self.host = host
+        self.puerto = puerto
+        self.duplicados = duplicados
+        self.ack = ack
+        self.azar = random.Random(semilla)
+        self.contadores = defaultdict(int)
+        self.caido_hasta = 0.0
+        self._sesiones = []
+        self._lock = threading.Lock()
+        self._escucha = None
+        self._detener = threading.Event()
+        self._grabar = open(grabar, "a", encoding="utf-8") if grabar else None
+        self._recientes = []
+
+        self.nodos = {
+            NODO_PROPIO: mesh_pb2.User(id=f"!{NODO_PROPIO:08x}", long_name="Nodo Simulado", short_name="SIM",
+                                       hw_model=mesh_pb2.HardwareModel.PORTDUINO)
+        }
+        for i in range(nodos):
+            num = 0x10000000 + i
+            self.nodos[num] = mesh_pb2.User(id=f"!{num:08x}", long_name=f"Vecino {i:03d}", short_name=f"V{i:03d}",
+                                            hw_model=mesh_pb2.HardwareModel.TBEAM)
+
+    def contar(self, clave, n=1):
+        with self._lock:
+            self.contadores[clave] += n
+
+    # --- conexiones ---
+
+    def _abrir(self):
+        escucha = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        escucha.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        escucha.bind((self.host, self.puerto))
+        escucha.listen(4)
+        escucha.settimeout(0.5)
+        return escucha
+
+    def _loop_aceptar(self):
+        while not self._detener.is_set():
+            if time.monotonic() < self.caido_hasta:
+                time.sleep(0.2)
+                continue
+            if self._escucha is None:
+                self._escucha = self._abrir()
+                print(f"Escuchando en {self.host}:{self.puerto}")
+            try:
+                sock, direccion = self._escucha.accept()
+            except (socket.timeout, OSError):
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sesion = Sesion(self, sock, direccion)
+            with self._lock:
+                self._sesiones.append(sesion)
+            self.contar("conexiones")
+            print(f"Cliente conectado: {direccion[0]}:{direccion[1]}")
+            threading.Thread(target=sesion.atender, name=f"Sesion-{direccion[1]}", daemon=True).start()
+
+    def quitar(self, sesion):
+        with self._lock:
+            if sesion in self._sesiones:
+                self._sesiones.remove(sesion)
+                print(f"Cliente desconectado: {sesion.direccion[0]}:{sesion.direccion[1]}")
+
+    def caer(self, segundos):
+        """Corta las conexiones abiertas y deja de aceptar otras durante `segundos` (radio reiniciando)."""
+        self.contar("cortes")
+        print(f"Corte: nodo caído {segundos:.0f}s")
+        self.caido_hasta = time.monotonic() + segundos
+        if self._escucha is not None and segundos > 0:
+            self._escucha.close()
+            self._escucha = None
+        with self._lock:
+            sesiones = list(self._sesiones)
+        for sesion in sesiones:
+            sesion.cerrar()
+
+    # --- tráfico hacia el bot ---
+
+    def emitir(self, paquete):
+        desde = mesh_pb2.FromRadio(packet=paquete)
+        with self._lock:
+            sesiones = [s for s in self._sesiones if s.configurada]
+        entregado = False
+        for sesion in sesiones:
+            entregado = sesion.enviar(desde) or entregado
+        if entregado:
+            self.contar(f"emitidos_{portnums_pb2.PortNum.Name(paquete.decoded.portnum)}")
+        else:
+            # Sin nadie conectado el paquete se pierde, como en la radio real
+            self.contar("perdidos_sin_cliente")
+
+    def paquete(self, portnum, payload, origen=None, destino=BROADCAST, request_id=0):
+        origen = origen or self.azar.choice([n for n in self.nodos if n != NODO_PROPIO])
+        paquete = mesh_pb2.MeshPacket(
+            id=self.azar.getrandbits(32) or 1, to=destino, channel=0,
+            hop_start=3, hop_limit=self.azar.randint(0, 3),
+            rx_snr=round(self.azar.uniform(-15, 10), 2), rx_rssi=self.azar.randint(-120, -40),
+            rx_time=int(time.time()),
+        )
+        setattr(paquete, "from", origen)
+        paquete.decoded.portnum = portnum
+        paquete.decoded.payload = payload
+        if request_id:
+            paquete.decoded.request_id = request_id
+        return paquete
+
+    def aleatorio(self, tipos=("TEXT", "POSITION", "NODEINFO", "TELEMETRY", "ROUTING"), pesos=(15, 30, 10, 35, 10)):
+        """Un paquete nuevo o, con probabilidad `duplicados`, otra copia de uno reciente."""
+        if self._recientes and self.azar.random() < self.duplicados:
+            copia = mesh_pb2.MeshPacket()
+            copia.CopyFrom(self.azar.choice(self._recientes))
+            copia.hop_limit = max(0, copia.hop_limit - 1)
+            copia.rx_snr = round(self.azar.uniform(-15, 10), 2)
+            self.contar("copias")
+            return copia
+
+        tipo = self.azar.choices(tipos, pesos)[0]
+        if tipo == "TEXT":
+            paquete = self.texto()
+        elif tipo == "POSITION":
+            posicion = mesh_pb2.Position(
+                latitude_i=int((-34.6 + self.azar.uniform(-0.3, 0.3)) * 1e7),
+                longitude_i=int((-58.4 + self.azar.uniform(-0.3, 0.3)) * 1e7),
+                altitude=self.azar.randint(0, 120), sats_in_view=self.azar.randint(3, 14),
+                PDOP=self.azar.randint(80, 400), time=int(time.time()),
+            )
+            paquete = self.paquete(portnums_pb2.PortNum.POSITION_APP, posicion.SerializeToString())
+        elif tipo == "NODEINFO":
+            num = self.azar.choice([n for n in self.nodos if n != NODO_PROPIO])
+            paquete = self.paquete(portnums_pb2.PortNum.NODEINFO_APP, self.nodos[num].SerializeToString(), origen=num)
+        elif tipo == "TELEMETRY":
+            telemetria = telemetry_pb2.Telemetry(time=int(time.time()))
+            telemetria.device_metrics.battery_level = self.azar.randint(5, 101)
+            telemetria.device_metrics.voltage = round(self.azar.uniform(3.3, 4.2), 3)
+            telemetria.device_metrics.channel_utilization = round(self.azar.uniform(0, 40), 2)
+            telemetria.device_metrics.air_util_tx = round(self.azar.uniform(0, 5), 2)
+            telemetria.device_metrics.uptime_seconds = self.azar.randint(0, 10 ** 6)
+            paquete = self.paquete(portnums_pb2.PortNum.TELEMETRY_APP, telemetria.SerializeToString())
+        else:
+            routing = mesh_pb2.Routing(error_reason=mesh_pb2.Routing.Error.NONE)
+            paquete = self.paquete(portnums_pb2.PortNum.ROUTING_APP, routing.SerializeToString(),
+                                   request_id=self.azar.getrandbits(32) or 1)
+
+        self._recientes.append(paquete)
+        del self._recientes[:-200]
+        return paquete
+
+    def texto(self, comando_prob=0.1):
+        if self.azar.random() < comando_prob:
+            texto = self.azar.choice(COMANDOS)
+        else:
+            texto = f"hola desde el simulador {self.azar.randint(0, 9999)}"
+        return self.paquete(portnums_pb2.PortNum.TEXT_MESSAGE_APP, texto.encode("utf-8"))
+
+    # --- tráfico del bot ---
+
+    def recibido_del_bot(self, sesion, paquete):
+        nombre = portnums_pb2.PortNum.Name(paquete.decoded.portnum) if paquete.HasField("decoded") else "ENCRIPTADO"
+        self.contar(f"recibidos_{nombre}")
+        if self._grabar:
+            registro = {
+                "fecha": datetime.now().isoformat(timespec="milliseconds"),
+                "cliente": f"{sesion.direccion[0]}:{sesion.direccion[1]}",
+                "id": paquete.id,
+                "to": f"!{paquete.to:08x}",
+                "canal": paquete.channel,
+                "want_ack": paquete.want_ack,
+                "portnum": nombre,
+            }
+            if paquete.decoded.portnum == portnums_pb2.PortNum.TEXT_MESSAGE_APP:
+                registro["texto"] = paquete.decoded.payload.decode("utf-8", "replace")
+            else:
+                registro["payload_b64"] = base64.b64encode(paquete.decoded.payload).decode("ascii")
+            with self._lock:
+                self._grabar.write(json.dumps(registro, ensure_ascii=False) + "\n")
+                self._grabar.flush()
+
+        if paquete.want_ack and paquete.id:
+            # ACK (o NAK) del destino después de la demora típica de la mesh
+            exito = self.azar.random() < self.ack
+            error = mesh_pb2.Routing.Error.NONE if exito else mesh_pb2.Routing.Error.MAX_RETRANSMIT
+            destino = paquete.to if paquete.to != BROADCAST else NODO_PROPIO
+            respuesta = self.paquete(portnums_pb2.PortNum.ROUTING_APP,
+                                     mesh_pb2.Routing(error_reason=error).SerializeToString(),
+                                     origen=destino, destino=NODO_PROPIO, request_id=paquete.id)
+            self.contar("acks" if exito else "naks")
+            threading.Timer(self.azar.uniform(0.5, 3.0), self.emitir, args=(respuesta,)).start()
+
+    # --- ciclo de vida ---
+
+    def start(self):
+        threading.Thread(target=self._loop_aceptar, name="Aceptar", daemon=True).start()
+
+    def esperar(self, segundos):
+        """Duerme; devuelve True si hay que terminar."""
+        return self._detener.wait(segundos)
+
+    def stop(self):
+        self._detener.set()
+        with self._lock:
+            sesiones = list(self._sesiones)
+        for sesion in sesiones:
+            sesion.cerrar()
+        if self._escucha is not None:
+            self._escucha.close()
+        if self._grabar:
+            self._grabar.close()
+
+    def resumen(self):
+        with self._lock:
+            return dict(sorted(self.contadores.items()))
+
+
+# ------------------------
+# PERFILES DE TRÁFICO
+# ------------------------
+
+def perfil_tormenta(sim, args, hasta):
+    # Muchos nodos hablando a la vez: la mitad de los paquetes son copias repetidas
+    duplicados, sim.duplicados = sim.duplicados, max(sim.duplicados, 0.5)
+    try:
+        while time.monotonic() < hasta:
+            sim.emitir(sim.aleatorio())
+            if sim.esperar(sim.azar.expovariate(args.tasa)):
+                return
+    finally:
+        sim.duplicados = duplicados
+
+
+def perfil_rafagas(sim, args, hasta):
+    while time.monotonic() < hasta:
+        for _ in range(sim.azar.randint(5, args.rafaga)):
+            sim.emitir(sim.texto(comando_prob=0.3))
+            if sim.esperar(sim.azar.uniform(0.05, 0.3)):
+                return
+        # El silencio no se pasa del final del tramo (en mixto hay otros perfiles esperando)
+        if sim.esperar(min(sim.azar.uniform(args.silencio / 2, args.silencio), max(0.0, hasta - time.monotonic()))):
+            return
+
+
+def perfil_goteo(sim, args, hasta):
+    while time.monotonic() < hasta:
+        sim.emitir(sim.aleatorio())
+        if sim.esperar(args.goteo):
+            return
+
+
+def perfil_cortes(sim, args, hasta):
+    proximo_corte = time.monotonic() + args.corte_cada
+    while time.monotonic() < hasta:
+        if time.monotonic() >= proximo_corte:
+            sim.caer(args.caida)
+            proximo_corte = time.monotonic() + args.caida + args.corte_cada
+        sim.emitir(sim.aleatorio())
+        if sim.esperar(sim.azar.expovariate(max(1.0, args.tasa / 10))):
+            return
+
+
+def perfil_mixto(sim, args, hasta):
+    # Con --duracion se reparte en cuatro tramos iguales; sin ella cada perfil
+    # dura --tramo segundos y el ciclo se repite hasta Ctrl+C
+    tramo = args.tramo if hasta == float("inf") else (hasta - time.monotonic()) / 4
+    while True:
+        for perfil in (perfil_goteo, perfil_rafagas, perfil_tormenta, perfil_cortes):
+            print(f"Perfil: {perfil.__name__.replace('perfil_', '')}")
+            perfil(sim, args, min(hasta, time.monotonic() + tramo))
+            if sim.esperar(0) or time.monotonic() >= hasta:
+                return
+
+
+PERFILES = {
+    "tormenta": perfil_tormenta,
+    "rafagas": perfil_rafagas,
+    "goteo": perfil_goteo,
+    "cortes": perfil_cortes,
+    "mixto": perfil_mixto,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nodo Meshtastic simulado (API TCP) para probar el bot sin radio")
+    parser.add_argument("--host", default="127.0.0.1", help="dirección donde escuchar")
+    parser.add_argument("--puerto", type=int, default=4403, help="puerto TCP (el de Meshtastic es 4403)")
+    parser.add_argument("--perfil", choices=sorted(PERFILES), default="mixto", help="tráfico a generar")
+    parser.add_argument("--duracion", type=float, default=0, help="segundos de tráfico (0 = hasta Ctrl+C)")
+    parser.add_argument("--espera", type=float, default=5, help="segundos antes de empezar a emitir")
+    parser.add_argument("--nodos", type=int, default=40, help="vecinos simulados en la mesh")
+    parser.add_argument("--tasa", type=float, default=100, help="paquetes por segundo en tormenta")
+    parser.add_argument("--duplicados", type=float, default=0.15, help="fracción de copias repetidas")
+    parser.add_argument("--rafaga", type=int, default=30, help="máximo de mensajes por ráfaga")
+    parser.add_argument("--silencio", type=float, default=20, help="segundos máximos entre ráfagas")
+    parser.add_argument("--goteo", type=float, default=5, help="segundos entre paquetes en goteo")
+    parser.add_argument("--corte-cada", type=float, default=60, help="segundos entre cortes de conexión")
+    parser.add_argument("--caida", type=float, default=15, help="segundos que el nodo queda caído en cada corte")
+    parser.add_argument("--tramo", type=float, default=300, help="segundos de cada perfil en mixto sin --duracion")
+    parser.add_argument("--ack", type=float, default=0.9, help="probabilidad de ACK para envíos con want_ack")
+    parser.add_argument("--grabar", help="JSONL donde guardar lo que transmite el bot")
+    parser.add_argument("--semilla", type=int, default=None, help="semilla del tráfico (repetible)")
+    args = parser.parse_args()
+
+    sim = NodoSimulado(args.host, args.puerto, args.nodos, args.duplicados, args.ack, args.grabar, args.semilla)
+    sim.start()
+    hasta = time.monotonic() + args.duracion if args.duracion else float("inf")
+    try:
+        if not sim.esperar(args.espera):
+            print(f"Perfil: {args.perfil}")
+            PERFILES[args.perfil](sim, args, hasta)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        print(json.dumps(sim.resumen(), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()